@@ -33,6 +33,8 @@ Requires Python >= 2.5 and < 3
 import sys, sqlite3
 
 from mc import mc
+from threaded import threaded_mc
+import schema
 
 
 __author__ = "Jake Hartz"
@@ -41,26 +43,28 @@ __license__ = "GPL"
 __version__ = "1.0"
 
 
-def open_database(path):
-    """Check and set up database based on "path", then return an mc ("MasterChess") instance."""
+def open_database(path, threaded=False, readonly=False, immutable=False):
+    """Check and set up database based on "path", then return an mc ("MasterChess") instance.
+    
+    If "threaded" is True, return a threaded_mc instead, which can be shared between threads.
+    
+    If "readonly" is True, open the database without setting it up or upgrading it (it must already exist), and refuse all writes. If "immutable" is also True, don't take any locks either (only use this if nothing else could be changing the file). (A read-only database can't be threaded.)
+    """
+    if readonly and threaded:
+        # Read-only connections keep the derived tables in TEMP tables of their own, which threaded_mc's per-thread connections wouldn't have
+        raise ValueError("a database can't be opened both readonly and threaded")
     try:
+        if readonly:
+            return mc(path, readonly=True, immutable=immutable)
+        
         conn = sqlite3.connect(path)
         if conn:
-            players = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='players';")
-            if len(players.fetchall()) == 0:
-                conn.execute("CREATE TABLE 'players' (id INTEGER PRIMARY KEY, deleted INTEGER, first_name TEXT, last_name TEXT, grade INTEGER);")
-            
-            matches = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='matches';")
-            if len(matches.fetchall()) == 0:
-                conn.execute("CREATE TABLE 'matches' (id INTEGER PRIMARY KEY, enabled INTEGER, timestamp INTEGER, white_player INTEGER, black_player INTEGER, outcome INTEGER);")
-            
-            prefs = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='prefs';")
-            if len(prefs.fetchall()) == 0:
-                conn.execute("CREATE TABLE 'prefs' (name TEXT UNIQUE NOT NULL, value TEXT);")
-            
-            conn.commit()
+            schema.upgrade(conn)
             conn.close()
-            mc_instance = mc(path)
+            if threaded:
+                mc_instance = threaded_mc(path)
+            else:
+                mc_instance = mc(path)
             if mc_instance:
                 return mc_instance
             else:
@@ -0,0 +1,178 @@
+"""
+Non-blocking front-end for the MasterChess API
+
+AsyncMC runs mc calls on a bounded pool of worker threads (sharing a threaded_mc, so each worker has its own read connection) and returns a Future for each call instead of blocking the caller. An event loop can hand the results back to itself from a callback, e.g.:
+
+    async_mc = AsyncMC(open_database(path, threaded=True))
+    future = async_mc.get_rankings(True)
+    future.add_done_callback(lambda f: loop.call_soon_threadsafe(on_rankings, f))
+
+Concurrent calls to the same read method with the same arguments are coalesced: while one is running, the others get the same Future instead of computing the result again. (Results shared this way should be treated as read-only.)
+
+Calls may run in any order relative to each other; wait for a write's Future before submitting anything that depends on it.
+"""
+
+import sys, threading, Queue
+
+from cache import make_key
+from threaded import threaded_mc
+
+# Methods that only read the database (and can be coalesced)
+READ_METHODS = ["get_players", "search_players", "get_matches", "get_match_summary", "get_match_page", "search_matches", "get_head_to_head", "get_grand_table", "get_rankings", "get_stats", "get_pref"]
+# Methods that change the database
+WRITE_METHODS = ["add_player", "add_players", "update_player", "remove_player", "add_match", "add_matches", "update_match", "remove_match", "update_ratings", "set_pref"]
+
+class TimeoutError(Exception):
+    """Raised by Future.result when the result isn't ready in time."""
+    pass
+
+class Future(object):
+    """The result of a call that is running (or waiting to run) in the background."""
+    
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+    
+    def done(self):
+        """Return whether the call has finished."""
+        return self._event.isSet()
+    
+    def result(self, timeout=None):
+        """Wait (up to "timeout" seconds, or forever if None) for the call to finish and return its result, or raise the exception it raised."""
+        self._wait(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+    
+    def exception(self, timeout=None):
+        """Wait (like result) for the call to finish and return the exception it raised, or None."""
+        self._wait(timeout)
+        return self._exc_info and self._exc_info[1] or None
+    
+    def add_done_callback(self, fn):
+        """Call fn(future) (in the worker thread) when the call finishes, or right away if it's already finished."""
+        self._lock.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        fn(self)
+    
+    def _wait(self, timeout):
+        self._event.wait(timeout)
+        if not self.done():
+            raise TimeoutError()
+    
+    def _finish(self, result=None, exc_info=None):
+        self._lock.acquire()
+        try:
+            self._result = result
+            self._exc_info = exc_info
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except:
+                exc_type, exc_value = sys.exc_info()[:2]
+                print >> sys.stderr, "Future callback ERROR:", exc_type, exc_value
+
+class AsyncMC(object):
+    """Runs MasterChess calls on "mc_instance" (which must be a threaded_mc) in a pool of at most "max_workers" threads. Every mc read and write method returns a Future (see the module docs)."""
+    
+    def __init__(self, mc_instance, max_workers=4):
+        if not isinstance(mc_instance, threaded_mc):
+            # A plain mc's connection can only be used by the thread that opened it
+            raise TypeError("AsyncMC needs a threaded_mc (open the database with threaded=True)")
+        self.mc = mc_instance
+        self.max_workers = max_workers
+        self._queue = Queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        # Futures for read calls that haven't finished yet, by cache key
+        self._pending = {}
+        self._closed = False
+    
+    def submit(self, name, *args, **kwargs):
+        """Call the mc method "name" with "args" and "kwargs" in the background and return a Future for its result."""
+        self._lock.acquire()
+        try:
+            if self._closed:
+                raise RuntimeError("AsyncMC is closed")
+            key = None
+            if name not in READ_METHODS:
+                # Reads submitted from now on may depend on this write, so they can't share a read that was already running
+                self._pending = {}
+            else:
+                key = make_key(name, args, kwargs)
+                if key in self._pending:
+                    return self._pending[key]
+            future = Future()
+            if key is not None:
+                self._pending[key] = future
+            if len(self._workers) < self.max_workers:
+                self._start_worker()
+        finally:
+            self._lock.release()
+        self._queue.put((future, key, name, args, kwargs))
+        return future
+    
+    def close(self):
+        """Finish the calls that have been submitted, then stop the workers and close the database."""
+        self._lock.acquire()
+        try:
+            self._closed = True
+            workers = self._workers
+        finally:
+            self._lock.release()
+        for worker in workers:
+            self._queue.put(None)
+        for worker in workers:
+            worker.join()
+        self.mc.uninit()
+    
+    def _start_worker(self):
+        worker = threading.Thread(target=self._work)
+        worker.setDaemon(True)
+        worker.start()
+        self._workers.append(worker)
+    
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            future, key, name, args, kwargs = task
+            try:
+                result = getattr(self.mc, name)(*args, **kwargs)
+                exc_info = None
+            except:
+                result = None
+                exc_info = sys.exc_info()
+            if key is not None:
+                # Calls from now on have to start a new computation (the database may have changed)
+                self._lock.acquire()
+                try:
+                    if self._pending.get(key) is future:
+                        del self._pending[key]
+                finally:
+                    self._lock.release()
+            future._finish(result, exc_info)
+
+def _make_method(name):
+    def method(self, *args, **kwargs):
+        return self.submit(name, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = "Run mc." + name + " in the background and return a Future for its result."
+    return method
+
+for _name in READ_METHODS + WRITE_METHODS:
+    setattr(AsyncMC, _name, _make_method(_name))
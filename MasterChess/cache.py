@@ -0,0 +1,138 @@
+import sys, threading
+
+from records import Record
+
+class ResultCache(object):
+    """A least-recently-used cache for the results of mc read methods.
+    
+    Every entry belongs to a version of the database; as soon as a different version is seen, all the entries are dropped (they can never be valid again). Entries are also evicted (least recently used first) when there are more than "max_entries" of them or when their estimated size is more than "max_bytes".
+    """
+    
+    def __init__(self, max_entries=64, max_bytes=8 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.clear()
+    
+    def clear(self):
+        """Remove all entries from the cache."""
+        # Each entry is a list: [last access tick, value, estimated size]
+        self._entries = {}
+        self._tick = 0
+        self.size = 0
+    
+    def set_version(self, version):
+        """Set the current database version, clearing the cache if it changed."""
+        self._lock.acquire()
+        try:
+            if version != self.version:
+                self.clear()
+                self.version = version
+        finally:
+            self._lock.release()
+    
+    def get(self, key):
+        """Return a copy of the cached value for "key", or raise KeyError if there isn't one."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            self._tick += 1
+            entry[0] = self._tick
+            value = entry[1]
+        finally:
+            self._lock.release()
+        return copy_result(value)
+    
+    def put(self, key, value, version):
+        """Store a copy of "value" (computed from database version "version") for "key", evicting old entries if needed."""
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            # Would push everything else out without ever fitting
+            return
+        value = copy_result(value)
+        self._lock.acquire()
+        try:
+            if version != self.version:
+                # The database changed (in another thread) while the value was being computed
+                return
+            if key in self._entries:
+                self.size -= self._entries[key][2]
+            self._tick += 1
+            self._entries[key] = [self._tick, value, size]
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                oldest_key = min(self._entries, key=lambda k: self._entries[k][0])
+                self.size -= self._entries.pop(oldest_key)[2]
+        finally:
+            self._lock.release()
+    
+    def __len__(self):
+        return len(self._entries)
+
+
+def cached(method):
+    """Decorator for mc read methods: use the mc instance's cache (if it has been enabled with enable_cache) for the method's results."""
+    def wrapper(self, *args, **kwargs):
+        cache = self._cache
+        if cache is None or self._reads_uncommitted():
+            # Inside a transaction, results may include writes that are still going to be rolled back
+            return method(self, *args, **kwargs)
+        version = self.get_data_version()
+        cache.set_version(version)
+        key = make_key(method.__name__, args, kwargs)
+        try:
+            return cache.get(key)
+        except KeyError:
+            result = method(self, *args, **kwargs)
+            cache.put(key, result, version)
+            return result
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+def make_key(name, args, kwargs):
+    """Return a hashable cache key for a call to method "name" with "args" and "kwargs"."""
+    return (name, freeze(args), freeze(kwargs))
+
+def freeze(value):
+    """Return a hashable version of "value" (lists become tuples, dicts become sorted tuples of items)."""
+    if isinstance(value, dict):
+        return ("dict",) + tuple(sorted((key, freeze(item)) for key, item in value.iteritems()))
+    elif isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(freeze(item) for item in value)
+    else:
+        return value
+
+def copy_result(value):
+    """Return a copy of "value" in which all the lists, dicts (including Structs), and records are new objects, so that callers can't change what's in the cache."""
+    if isinstance(value, Record):
+        return value.copy()
+    elif isinstance(value, dict):
+        return type(value)(dict((key, copy_result(item)) for key, item in value.iteritems()))
+    elif isinstance(value, list):
+        return [copy_result(item) for item in value]
+    elif isinstance(value, tuple):
+        return tuple(copy_result(item) for item in value)
+    else:
+        return value
+
+def estimate_size(value):
+    """Return a rough estimate of the memory (in bytes) used by "value" and everything in it."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            size += sys.getsizeof(key) + estimate_size(item)
+    elif isinstance(value, Record):
+        for item in value.values():
+            size += estimate_size(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += estimate_size(item)
+    return size
@@ -0,0 +1,188 @@
+"""
+Streaming CSV importer for MasterChess databases
+
+Players CSV files need a header row with the columns "first_name", "last_name", and (optionally) "grade".
+
+Matches CSV files need a header row with the columns "white", "black", "outcome", and (optionally) "timestamp". "white" and "black" are player names ("First Last" or "Last, First"); players that don't exist yet are created. "outcome" is either a number (see the "outcome" values in the MasterChess module) or one of the names in OUTCOMES. "timestamp" is either seconds since the epoch or a date (YYYY-MM-DD).
+
+Rows are read and inserted in chunks (each chunk in one transaction), so memory use doesn't depend on the size of the file.
+
+Usage from the command line:
+    python -m MasterChess.importer database.mcdb players|matches file.csv
+"""
+
+from __future__ import with_statement
+import sys, csv, time, datetime, itertools
+
+from mc import Struct
+
+OUTCOMES = {
+    "white": 0,
+    "1-0": 0,
+    "black": 1,
+    "0-1": 1,
+    "stalemate": 2,
+    "draw": 3,
+    "1/2-1/2": 3
+}
+
+def read_rows(csvfile, encoding="utf-8"):
+    """Generate a dict for each row in "csvfile" (a file opened in binary mode, or a path), with all values decoded to unicode."""
+    if isinstance(csvfile, basestring):
+        f = open(csvfile, "rb")
+        try:
+            for row in read_rows(f, encoding):
+                yield row
+        finally:
+            f.close()
+        return
+    for row in csv.DictReader(csvfile):
+        yield dict((key, (value or "").decode(encoding).strip()) for key, value in row.iteritems() if key)
+
+def chunks(iterable, chunk_size):
+    """Generate lists of (at most) "chunk_size" items from "iterable"."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def split_name(name):
+    """Return a tuple of (first_name, last_name) from "First Last" or "Last, First"."""
+    if "," in name:
+        last_name, first_name = name.split(",", 1)
+    elif " " in name:
+        first_name, last_name = name.rsplit(" ", 1)
+    else:
+        first_name, last_name = u"", name
+    return first_name.strip(), last_name.strip()
+
+def parse_outcome(value):
+    """Return the "outcome" number for "value" (a number or one of the names in OUTCOMES)."""
+    value = value.lower()
+    if value in OUTCOMES:
+        return OUTCOMES[value]
+    outcome = int(value)
+    if outcome not in (0, 1, 2, 3):
+        raise ValueError("invalid outcome: %d" % outcome)
+    return outcome
+
+def parse_timestamp(value):
+    """Return seconds since the epoch for "value" (a number, a YYYY-MM-DD date, or empty for "now")."""
+    if not value:
+        return 0
+    try:
+        return float(value)
+    except ValueError:
+        return time.mktime(datetime.datetime.strptime(value, "%Y-%m-%d").timetuple())
+
+
+class PlayerIndex(object):
+    """In-memory index of player names to player IDs, which creates players that aren't in the database yet."""
+    
+    def __init__(self, mc, create_players=True):
+        self.mc = mc
+        self.create_players = create_players
+        self.created = 0
+        self._ids = {}
+        # Include deleted players too, so we don't create duplicates of them
+        for id, first_name, last_name in mc._read_conn().execute("SELECT id, first_name, last_name FROM players ORDER BY deleted, id"):
+            key = self.make_key(first_name, last_name)
+            if key not in self._ids:
+                self._ids[key] = id
+    
+    def make_key(self, first_name, last_name):
+        return ((first_name or u"").lower(), (last_name or u"").lower())
+    
+    def get_id(self, name):
+        """Return the ID of the player named "name", creating the player if needed."""
+        first_name, last_name = split_name(name)
+        key = self.make_key(first_name, last_name)
+        if key not in self._ids:
+            if not self.create_players:
+                raise ValueError("unknown player: %s" % name)
+            self._ids[key] = self.mc.add_player(first_name, last_name)
+            self.created += 1
+        return self._ids[key]
+
+
+def import_players(mc, csvfile, chunk_size=1000, encoding="utf-8", progress=None):
+    """Import players from "csvfile" (a file opened in binary mode, or a path) into "mc" and return a Struct with import statistics.
+    
+    If "progress" is specified, it is called with the import statistics (so far) after every chunk.
+    """
+    def players():
+        for line_num, row in enumerate(read_rows(csvfile, encoding)):
+            try:
+                yield (row["first_name"], row["last_name"], int(row.get("grade") or 0))
+            except (KeyError, ValueError), e:
+                raise ValueError("row %d: %s" % (line_num + 1, e))
+    
+    stats = Struct({"rows": 0, "players_created": 0, "seconds": 0.0, "rows_per_second": 0.0})
+    start = time.time()
+    for chunk in chunks(players(), chunk_size):
+        mc.add_players(chunk)
+        stats.rows += len(chunk)
+        stats.players_created += len(chunk)
+        update_rate(stats, start)
+        if progress:
+            progress(stats)
+    update_rate(stats, start)
+    return stats
+
+def import_matches(mc, csvfile, chunk_size=1000, create_players=True, encoding="utf-8", progress=None):
+    """Import matches from "csvfile" (a file opened in binary mode, or a path) into "mc" and return a Struct with import statistics.
+    
+    Players are looked up by name; if "create_players" is False, unknown players raise a ValueError instead of being created. If "progress" is specified, it is called with the import statistics (so far) after every chunk.
+    """
+    index = PlayerIndex(mc, create_players)
+    
+    def matches():
+        for line_num, row in enumerate(read_rows(csvfile, encoding)):
+            try:
+                yield (index.get_id(row["white"]), index.get_id(row["black"]), parse_outcome(row["outcome"]), parse_timestamp(row.get("timestamp")))
+            except (KeyError, ValueError), e:
+                raise ValueError("row %d: %s" % (line_num + 1, e))
+    
+    stats = Struct({"rows": 0, "players_created": 0, "seconds": 0.0, "rows_per_second": 0.0})
+    start = time.time()
+    rows = matches()
+    while True:
+        # Players created while reading a chunk go in the same transaction as the chunk's matches
+        with mc.transaction():
+            chunk = list(itertools.islice(rows, chunk_size))
+            if chunk:
+                mc.add_matches(chunk)
+        if not chunk:
+            break
+        stats.rows += len(chunk)
+        stats.players_created = index.created
+        update_rate(stats, start)
+        if progress:
+            progress(stats)
+    update_rate(stats, start)
+    return stats
+
+def update_rate(stats, start):
+    stats.seconds = time.time() - start
+    if stats.seconds > 0:
+        stats.rows_per_second = stats.rows / stats.seconds
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[2] in ("players", "matches"):
+        from MasterChess import open_database
+        mc_instance = open_database(sys.argv[1])
+        if mc_instance:
+            def progress(stats):
+                print >> sys.stderr, "%d rows (%d rows/second)" % (stats.rows, stats.rows_per_second)
+            if sys.argv[2] == "players":
+                stats = import_players(mc_instance, sys.argv[3], progress=progress)
+            else:
+                stats = import_matches(mc_instance, sys.argv[3], progress=progress)
+            print "Imported %d rows in %.1f seconds (%d rows/second, %d players created)" % (stats.rows, stats.seconds, stats.rows_per_second, stats.players_created)
+    else:
+        print >> sys.stderr, "Usage: python -m MasterChess.importer database.mcdb players|matches file.csv"
@@ -0,0 +1,187 @@
+"""
+Instrumentation for MasterChess: call counts and latency histograms for the mc methods, and a log of the SQL statements they run
+
+Nothing is recorded until Instrumentation.enable is called (usually through mc.enable_instrumentation). Until then, the only cost is checking a flag once per method call and once per statement.
+
+Python 2's sqlite3 module has no trace callback, so statements are traced by the connection class (InstrumentedConnection) that mc opens its connections with. A statement's time is the time spent in execute/executemany, which for a query covers the work to find the first row (all of it, for aggregates and sorted queries) but not fetching the rest.
+"""
+
+import time, threading, sqlite3
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# Upper bounds (in milliseconds) of the latency histogram buckets; the last bucket has no upper bound
+HISTOGRAM_BOUNDS = [0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000]
+
+class Instrumentation(object):
+    """Collects method timings and statements for one mc instance (and all of its connections)."""
+    
+    def __init__(self):
+        self.enabled = False
+        self.slow_query_ms = 100.0
+        self.max_statements = 1000
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+    
+    def enable(self, slow_query_ms=100.0, max_statements=1000):
+        """Start recording. Statements that take at least "slow_query_ms" milliseconds are also kept in a list of slow statements. Only the last "max_statements" statements (and slow statements) are kept."""
+        self.slow_query_ms = slow_query_ms
+        self.max_statements = max_statements
+        self.enabled = True
+    
+    def disable(self):
+        """Stop recording (what has been recorded so far is kept until reset)."""
+        self.enabled = False
+    
+    def reset(self):
+        """Throw away everything recorded so far."""
+        self._lock.acquire()
+        try:
+            # Method name -> [calls, total seconds, max seconds, histogram counts]
+            self._methods = {}
+            # SQL -> [calls, total seconds, max seconds]
+            self._statement_totals = {}
+            self._statements = []
+            self._slow_statements = []
+            self._dropped = 0
+        finally:
+            self._lock.release()
+    
+    def _method_stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+    
+    def record_call(self, name, seconds):
+        """Record a call to the method "name" that took "seconds"."""
+        ms = seconds * 1000
+        bucket = 0
+        while bucket < len(HISTOGRAM_BOUNDS) and ms > HISTOGRAM_BOUNDS[bucket]:
+            bucket += 1
+        self._lock.acquire()
+        try:
+            if name not in self._methods:
+                self._methods[name] = [0, 0.0, 0.0, [0] * (len(HISTOGRAM_BOUNDS) + 1)]
+            stats = self._methods[name]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3][bucket] += 1
+        finally:
+            self._lock.release()
+    
+    def record_statement(self, sql, seconds, rows=None):
+        """Record that the statement "sql" took "seconds" (and, for executemany, changed "rows" rows)."""
+        sql = " ".join(sql.split())
+        stack = self._method_stack()
+        entry = {
+            "sql": sql,
+            "ms": seconds * 1000,
+            "method": stack and stack[-1] or None,
+            "time": time.time()
+        }
+        if rows is not None:
+            entry["rows"] = rows
+        self._lock.acquire()
+        try:
+            if sql not in self._statement_totals:
+                self._statement_totals[sql] = [0, 0.0, 0.0]
+            totals = self._statement_totals[sql]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+            self._statements.append(entry)
+            if len(self._statements) > self.max_statements:
+                del self._statements[0]
+                self._dropped += 1
+            if entry["ms"] >= self.slow_query_ms:
+                self._slow_statements.append(entry)
+                if len(self._slow_statements) > self.max_statements:
+                    del self._slow_statements[0]
+        finally:
+            self._lock.release()
+    
+    def snapshot(self):
+        """Return everything recorded so far as a dict (of plain lists, dicts, strings, and numbers)."""
+        self._lock.acquire()
+        try:
+            methods = {}
+            for name, (calls, total, longest, histogram) in self._methods.iteritems():
+                methods[name] = {
+                    "calls": calls,
+                    "total_ms": total * 1000,
+                    "mean_ms": total * 1000 / calls,
+                    "max_ms": longest * 1000,
+                    "histogram": [{"le_ms": bound, "count": count} for bound, count in zip(HISTOGRAM_BOUNDS + [None], histogram)]
+                }
+            statement_totals = [{"sql": sql, "calls": calls, "total_ms": total * 1000, "max_ms": longest * 1000} for sql, (calls, total, longest) in self._statement_totals.iteritems()]
+            statement_totals.sort(key=lambda totals: totals["total_ms"], reverse=True)
+            return {
+                "enabled": self.enabled,
+                "slow_query_ms": self.slow_query_ms,
+                "methods": methods,
+                "statement_totals": statement_totals,
+                "statements": [dict(entry) for entry in self._statements],
+                "statements_dropped": self._dropped,
+                "slow_statements": [dict(entry) for entry in self._slow_statements]
+            }
+        finally:
+            self._lock.release()
+    
+    def to_json(self):
+        """Return snapshot() as a JSON string."""
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+def timed(name, method):
+    """Wrap the mc method "method" so that its calls are recorded by the instance's instrumentation (when it's enabled)."""
+    def wrapper(self, *args, **kwargs):
+        instrumentation = self._instrumentation
+        if not instrumentation.enabled:
+            return method(self, *args, **kwargs)
+        stack = instrumentation._method_stack()
+        stack.append(name)
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            instrumentation.record_call(name, time.time() - start)
+            stack.pop()
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """sqlite3 cursor that reports its statements to its connection's instrumentation."""
+    
+    def execute(self, sql, *args):
+        instrumentation = self.connection.instrumentation
+        if instrumentation is None or not instrumentation.enabled:
+            return sqlite3.Cursor.execute(self, sql, *args)
+        start = time.time()
+        try:
+            return sqlite3.Cursor.execute(self, sql, *args)
+        finally:
+            instrumentation.record_statement(sql, time.time() - start)
+    
+    def executemany(self, sql, seq_of_parameters):
+        instrumentation = self.connection.instrumentation
+        if instrumentation is None or not instrumentation.enabled:
+            return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+        start = time.time()
+        try:
+            return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+        finally:
+            instrumentation.record_statement(sql, time.time() - start, self.rowcount)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3 connection whose statements (including ones run through Connection.execute) are reported to "instrumentation", if it's set."""
+    
+    instrumentation = None
+    
+    def cursor(self, factory=None):
+        return sqlite3.Connection.cursor(self, factory or InstrumentedCursor)
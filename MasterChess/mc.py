@@ -1,6 +1,13 @@
-import sqlite3, os, atexit, datetime, time, sys
+import sqlite3, os, atexit, datetime, time, sys, contextlib, threading
 
 from rankings import get_rankings
+from cache import ResultCache, cached
+from records import Player, Match, MatchWithPlayers, Stats
+from instrument import Instrumentation, InstrumentedConnection, timed
+import schema, ratings
+
+# Default SQLite limit on the number of "?" parameters in a single statement
+SQLITE_MAX_VARIABLES = 999
 
 class Struct(dict):
     """A dict that can be accessed like an object."""
@@ -32,87 +39,342 @@ class Struct(dict):
         # Slightly prettier than default (object keys aren't put through repr)
         return "{" + ", ".join("%s: %s" % (key, repr(value)) for (key, value) in self.iteritems()) + "}"
 
+def make_stats(white_wins, white_losses, black_wins, black_losses, stalemates, draws, total):
+    """Return a player's stats (the "stats" of get_players) from the individual outcome counts."""
+    return Stats(white_wins + black_wins, white_wins, black_wins, white_losses + black_losses, white_losses, black_losses, stalemates, draws, total)
+
+def make_player(row, stats):
+    """Return a Player from a (id, first_name, last_name, grade) row and a dict of stats tuples (see mc._get_player_stats)."""
+    return Player(row[0], row[1], row[2], row[3], make_stats(*stats.get(row[0], (0, 0, 0, 0, 0, 0, 0))))
+
+def player_stats_row_factory(cursor, row):
+    """sqlite3 row_factory that builds a Player from a (id, first_name, last_name, grade, white_wins, white_losses, black_wins, black_losses, stalemates, draws, total) row."""
+    return Player(row[0], row[1], row[2], row[3], make_stats(*row[4:]))
+
+# Players with their totals from the player_stats table (for player_stats_row_factory)
+PLAYERS_WITH_STATS_SELECT = """
+    SELECT id, first_name, last_name, grade,
+        IFNULL(white_wins, 0), IFNULL(white_losses, 0), IFNULL(black_wins, 0), IFNULL(black_losses, 0), IFNULL(stalemates, 0), IFNULL(draws, 0), IFNULL(total, 0)
+    FROM players LEFT JOIN player_stats ON player_stats.player=players.id"""
+
+# All the players that aren't deleted, with their totals
+PLAYERS_WITH_STATS = PLAYERS_WITH_STATS_SELECT + """
+    WHERE deleted!=1
+    ORDER BY last_name, first_name"""
+
+# Matches with the details of both players (deleted players included, and LEFT JOINs so that a match is never left out)
+MATCHES_WITH_PLAYERS = """
+    SELECT matches.id, matches.enabled, matches.timestamp, matches.white_player, matches.black_player, matches.outcome,
+        white.first_name, white.last_name, white.grade, white.deleted,
+        black.first_name, black.last_name, black.grade, black.deleted
+    FROM matches
+        LEFT JOIN players AS white ON white.id=matches.white_player
+        LEFT JOIN players AS black ON black.id=matches.black_player"""
+
+def match_filter(conn, exclude_disabled, player_ids):
+    """Return the WHERE clause for the matches that get_match_page, get_match_summary, and search_matches include."""
+    where = exclude_disabled and "matches.enabled=1" or "1"
+    if player_ids is None:
+        return where
+    # IDs are put in the SQL directly (they're integers), so there's no limit on how many there can be
+    in_list = "(" + ", ".join(str(int(id)) for id in player_ids) + ")"
+    # Every match is counted twice in player_stats (once for each player)
+    played, total = conn.execute("SELECT SUM(CASE WHEN player IN " + in_list + " THEN total ELSE 0 END), SUM(total) FROM player_stats").fetchone()
+    if (played or 0) * 8 < (total or 0):
+        # Only a few of the matches: look them up in matches_white and matches_black (SQLite answers the "OR" below by scanning every match)
+        enabled = exclude_disabled and " AND enabled=1" or ""
+        return "matches.id IN (SELECT id FROM matches WHERE white_player IN " + in_list + enabled + " UNION ALL SELECT id FROM matches WHERE black_player IN " + in_list + enabled + ")"
+    return where + " AND (matches.white_player IN " + in_list + " OR matches.black_player IN " + in_list + ")"
+
+def player_row_factory(stats):
+    """Return a sqlite3 row_factory that builds Players from (id, first_name, last_name, grade) rows and the dict "stats"."""
+    def row_factory(cursor, row):
+        return make_player(row, stats)
+    return row_factory
+
+def iter_rows(cur, batch_size):
+    """Generate the rows from cursor "cur", fetching "batch_size" rows at a time."""
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+def fetch_by_ids(cur, sql, ids):
+    """Run "sql" (a query ending in "WHERE id IN ") on cursor "cur" for all of "ids", in as few queries as SQLITE_MAX_VARIABLES allows, and return the records built by the cursor's row_factory in the same order as "ids" (leaving out IDs that weren't found)."""
+    found = {}
+    unique_ids = list(set(ids))
+    for start in xrange(0, len(unique_ids), SQLITE_MAX_VARIABLES):
+        chunk = unique_ids[start:start + SQLITE_MAX_VARIABLES]
+        for item in cur.execute(sql + "(" + ", ".join("?" for i in chunk) + ")", tuple(chunk)):
+            found[item.id] = item
+    items = []
+    used = set()
+    for id in ids:
+        if id in found:
+            item = found[id]
+            if id in used:
+                # An ID that's asked for twice gets its own copy, like it would from separate queries
+                item = item.copy()
+            else:
+                used.add(id)
+            items.append(item)
+    return items
+
+def writes(method):
+    """Decorator for mc write methods: hold the instance's write lock while writing."""
+    def wrapper(self, *args, **kwargs):
+        if self.readonly:
+            raise sqlite3.OperationalError("attempt to write a readonly database")
+        self._write_lock.acquire()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._write_lock.release()
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
 class mc(object):
     """MasterChess base class."""
     
-    def __init__(self, db_path, out=sys.stdout):
+    def __init__(self, db_path, out=sys.stdout, readonly=False, immutable=False):
         self.db_path = db_path
-        self._db_conn = sqlite3.connect(self.db_path)
+        self.readonly = readonly
+        self.immutable = immutable
+        self._instrumentation = Instrumentation()
+        self._db_conn = self._connect()
         self.isinit = True
         
+        # Bumped on every write through this instance (PRAGMA data_version only sees other connections' writes)
+        self._write_count = 0
+        self._cache = None
+        self._transaction_depth = 0
+        # Held while writing (and for the whole of a transaction)
+        self._write_lock = threading.RLock()
+        self._transaction_thread = None
+        # data_version is checked through a connection of its own: running a PRAGMA on the writing connection would commit an open transaction
+        self._version_conn = readonly and self._db_conn or self._connect()
+        self._version_lock = threading.Lock()
+        
         atexit.register(self.uninit)
     
+    def _connect(self):
+        """Return a new connection to the database."""
+        if self.readonly:
+            conn = schema.connect_readonly(self.db_path, self.immutable, InstrumentedConnection)
+        else:
+            conn = sqlite3.connect(self.db_path, factory=InstrumentedConnection)
+        conn.instrumentation = self._instrumentation
+        return conn
+    
+    def _read_conn(self):
+        """Return the connection to use for reading (the same one as for writing, unless a subclass says otherwise)."""
+        return self._db_conn
+    
+    def _reads_uncommitted(self):
+        """Return whether reads in this thread can see writes that haven't been committed yet (which must not be cached)."""
+        # Every thread reads through the writing connection
+        return self._transaction_depth > 0
+    
     def uninit(self):
         """Close database. (automatically set to call at exit)"""
         if self.isinit:
             try:
+                if self._version_conn is not self._db_conn:
+                    self._version_conn.close()
                 self._db_conn.close()
                 self.isinit = False
             except:
                 pass
     
     
+    def enable_cache(self, max_entries=64, max_bytes=8 * 1024 * 1024):
+        """Start caching the results of the read methods (get_players, get_matches, get_grand_table, get_rankings, get_stats, etc.).
+        
+        Cached results are thrown away whenever the database changes (including changes made by other processes). At most "max_entries" results, taking up about "max_bytes" of memory, are kept; the least recently used ones are dropped first.
+        """
+        self._cache = ResultCache(max_entries, max_bytes)
+    
+    def disable_cache(self):
+        """Stop caching results and free the cache."""
+        self._cache = None
+    
+    def enable_instrumentation(self, slow_query_ms=100.0, max_statements=1000):
+        """Start recording the number of calls and the latency of each public method, and a log of every SQL statement run with how long it took (see the instrument module). Statements that take at least "slow_query_ms" milliseconds are also kept in a list of slow statements. Only the last "max_statements" statements are kept."""
+        self._instrumentation.enable(slow_query_ms, max_statements)
+    
+    def disable_instrumentation(self):
+        """Stop recording (what has been recorded is kept until reset_instrumentation)."""
+        self._instrumentation.disable()
+    
+    def reset_instrumentation(self):
+        """Throw away everything the instrumentation has recorded."""
+        self._instrumentation.reset()
+    
+    def get_instrumentation(self, as_json=False):
+        """Return everything the instrumentation has recorded, as a dict (or as a JSON string if "as_json" is True)."""
+        if as_json:
+            return self._instrumentation.to_json()
+        return self._instrumentation.snapshot()
+    
+    def get_data_version(self):
+        """Return a value that changes whenever the database is changed, either through this instance or by any other connection."""
+        self._version_lock.acquire()
+        try:
+            result = self._version_conn.execute("PRAGMA data_version").fetchone()
+        finally:
+            self._version_lock.release()
+        if result:
+            return (result[0], self._write_count)
+        else:
+            # Older SQLite without data_version; fall back to the file's modification time and size
+            stat = os.stat(self.db_path)
+            return (stat.st_mtime, stat.st_size, self._write_count)
+    
+    
+    def _commit(self):
+        """Commit the changes made by a write method (unless we're in a transaction)."""
+        self._write_count += 1
+        if self._transaction_depth == 0:
+            self._db_conn.commit()
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        """Context manager that groups all the writes inside it into one transaction (committed once at the end, or rolled back if there's an exception).
+        
+        Usage:
+            with mc_instance.transaction():
+                mc_instance.add_match(...)
+                mc_instance.add_match(...)
+        
+        Transactions can be nested; only the outermost one commits.
+        """
+        self._write_lock.acquire()
+        try:
+            self._transaction_thread = threading.currentThread()
+            self._transaction_depth += 1
+            try:
+                yield self
+            except:
+                self._transaction_depth -= 1
+                if self._transaction_depth == 0:
+                    self._db_conn.rollback()
+                    # Anything cached while the transaction was open was read at a version that's gone now
+                    self._write_count += 1
+                raise
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self._db_conn.commit()
+                self._write_count += 1
+        finally:
+            if self._transaction_depth == 0:
+                self._transaction_thread = None
+            self._write_lock.release()
+    
+    
     def get_pref(self, pref_name):
-        result = self._db_conn.execute("SELECT name, value FROM prefs WHERE name=?", (pref_name,)).fetchone()
+        result = self._read_conn().execute("SELECT name, value FROM prefs WHERE name=?", (pref_name,)).fetchone()
         if result:
             return result[1]
         else:
             return None
     
+    @writes
     def set_pref(self, pref_name, pref_value):
         result = self.get_pref(pref_name)
         if result != None:
             self._db_conn.execute("UPDATE prefs SET value=? WHERE name=?", (pref_value, pref_name))
         else:
             self._db_conn.execute("INSERT INTO prefs(name, value) VALUES (?, ?);", (pref_name, pref_value))
-        self._db_conn.commit()
+        self._commit()
     
     
+    @writes
     def add_player(self, first_name, last_name, grade=0):
-        """Add a new player."""
-        self._db_conn.execute("INSERT INTO players(deleted, first_name, last_name, grade) VALUES (0, ?, ?, ?);", (first_name, last_name, grade))
-        self._db_conn.commit()
+        """Add a new player and return its ID."""
+        cur = self._db_conn.execute("INSERT INTO players(deleted, first_name, last_name, grade) VALUES (0, ?, ?, ?);", (first_name, last_name, grade))
+        schema.update_player_search(self._db_conn, [(cur.lastrowid, first_name, last_name)])
+        self._commit()
+        return cur.lastrowid
     
+    @writes
+    def add_players(self, players):
+        """Add many new players at once. "players" is an iterable of (first_name, last_name) or (first_name, last_name, grade) tuples."""
+        def rows():
+            for player in players:
+                first_name, last_name = player[:2]
+                grade = len(player) > 2 and player[2] or 0
+                yield (first_name, last_name, grade)
+        last_id = self._db_conn.execute("SELECT MAX(id) FROM players").fetchone()[0] or 0
+        self._db_conn.executemany("INSERT INTO players(deleted, first_name, last_name, grade) VALUES (0, ?, ?, ?);", rows())
+        schema.update_player_search(self._db_conn, self._db_conn.execute("SELECT id, first_name, last_name FROM players WHERE id>?", (last_id,)))
+        self._commit()
+    
+    @writes
     def update_player(self, id, props):
         """Update a player's metadata."""
         columns = [i[0] for i in self._db_conn.execute("SELECT * FROM players").description]
         for name, value in props.iteritems():
             if name in columns:
                 self._db_conn.execute("UPDATE players SET " + name + "=? WHERE id=?", (value, id))
-        self._db_conn.commit()
+        if "first_name" in props or "last_name" in props:
+            schema.update_player_search(self._db_conn, self._db_conn.execute("SELECT id, first_name, last_name FROM players WHERE id=?", (id,)))
+        self._commit()
     
+    @writes
     def remove_player(self, id):
         """Remove a player from the database."""
         # Just set "deleted" to 1 - so we don't show it in listings, but we can still access it if it is a value in matches
         self._db_conn.execute("UPDATE players SET deleted=1 WHERE id=?", (id,))
-        self._db_conn.commit()
+        self._commit()
     
     
+    @writes
     def add_match(self, white_player, black_player, outcome, timestamp=0):
         """Add a new match."""
         timestamp = timestamp or time.time()
         self._db_conn.execute("INSERT INTO matches(enabled, timestamp, white_player, black_player, outcome) VALUES (1, ?, ?, ?, ?);", (timestamp, white_player, black_player, outcome))
-        self._db_conn.commit()
+        # Keep up-to-date ratings up to date while it's cheap (anything else waits until get_rankings needs them)
+        for name in ratings.METHODS:
+            ratings.append(self._db_conn, name)
+        self._commit()
+    
+    @writes
+    def add_matches(self, matches):
+        """Add many new matches at once. "matches" is an iterable of (white_player, black_player, outcome) or (white_player, black_player, outcome, timestamp) tuples."""
+        now = time.time()
+        def rows():
+            for match in matches:
+                white_player, black_player, outcome = match[:3]
+                timestamp = len(match) > 3 and match[3] or now
+                yield (timestamp, white_player, black_player, outcome)
+        self._db_conn.executemany("INSERT INTO matches(enabled, timestamp, white_player, black_player, outcome) VALUES (1, ?, ?, ?, ?);", rows())
+        self._commit()
     
+    @writes
     def update_match(self, id, props):
         """Update a match's metadata."""
         columns = [i[0] for i in self._db_conn.execute("SELECT * FROM matches").description]
         for name, value in props.iteritems():
             if name in columns:
                 self._db_conn.execute("UPDATE matches SET " + name + "=? WHERE id=?", (value, id))
-        self._db_conn.commit()
+        self._commit()
     
+    @writes
     def remove_match(self, id):
         """Permanenty remove a match from the database."""
         # Permanently delete (unlike remove_player)
         self._db_conn.execute("DELETE FROM matches WHERE id=?", (id,))
-        self._db_conn.commit()
+        self._commit()
     
     
-    def get_players(self, ids=[], verses=[]):
+    @cached
+    def get_players(self, ids=[], verses=[], since=None, until=None):
         """Get details about players in the database.
         
-        Return details about individual players by specifying them in "ids", or get details for all players if "ids" is empty. If "verses" is specified with one or more player IDs, the stats of the players in "ids" will only reflect the games they played against the players in "verses".
+        Return details about individual players by specifying them in "ids", or get details for all players if "ids" is empty. If "verses" is specified with one or more player IDs, the stats of the players in "ids" will only reflect the games they played against the players in "verses". If "since" and/or "until" are specified, the stats will only reflect the matches with since <= timestamp < until.
         """
         # TODO: for functions like this that accept either an array or a plain argument, maybe see if we can change it so that if we send it an array it returns an array, but if we send it a plain object it returns a plain object
         if not isinstance(ids, list):
@@ -126,120 +388,301 @@ class mc(object):
             else:
                 verses = []
         
-        items = []
+        cur = self._read_conn().cursor()
+        if len(ids) == 0 and len(verses) == 0 and since is None and until is None:
+            # The most common case: all the totals are already in player_stats
+            cur.row_factory = player_stats_row_factory
+            return cur.execute(PLAYERS_WITH_STATS).fetchall()
+        
         if len(ids) == 0:
-            items = self._db_conn.execute("SELECT id, first_name, last_name, grade FROM players WHERE deleted!=1 ORDER BY last_name, first_name").fetchall()
+            stats = self._get_player_stats(None, verses, since, until)
         else:
-            items = []
-            for id in ids:
-                result = self._db_conn.execute("SELECT id, first_name, last_name, grade FROM players WHERE id=?", (id,)).fetchone()
-                if result:
-                    items.append(result)
-        
-        returnitems = []
-        for i in items:
-            returnitem = {
-                "id": i[0],
-                "first_name": i[1],
-                "last_name": i[2],
-                "grade": i[3]
-            }
-            white_wins = 0
-            white_losses = 0
-            black_wins = 0
-            black_losses = 0
-            stalemates = 0
-            draws = 0
-            total = 0
-            
-            if len(verses) > 0:
-                cur = self._db_conn.execute("SELECT outcome, white_player FROM matches WHERE enabled=1 AND white_player=? AND (" + (" OR ".join("black_player=?" for i in xrange(len(verses)))) + ")", tuple([i[0]] + verses))
+            stats = self._get_player_stats(ids, verses, since, until)
+        
+        cur.row_factory = player_row_factory(stats)
+        if len(ids) == 0:
+            return cur.execute("SELECT id, first_name, last_name, grade FROM players WHERE deleted!=1 ORDER BY last_name, first_name").fetchall()
+        else:
+            return fetch_by_ids(cur, "SELECT id, first_name, last_name, grade FROM players WHERE id IN ", ids)
+    
+    def iter_players(self, verses=[], batch_size=500, since=None, until=None):
+        """Generate the same details as get_players for all players, reading them from the database "batch_size" players at a time instead of all at once.
+        
+        Don't write to the database through this instance while iterating (committing resets the open query).
+        """
+        if not isinstance(verses, list):
+            if verses:
+                verses = [verses]
             else:
-                cur = self._db_conn.execute("SELECT outcome FROM matches WHERE enabled=1 AND white_player=?", (i[0],))
-            for match in cur.fetchall():
-                total += 1
-                if match[0] == 0:
-                    # White won
-                    white_wins += 1
-                elif match[0] == 1:
-                    # Black won
-                    white_losses += 1
-                elif match[0] == 2:
-                    # Stalemate
-                    stalemates += 1
-                else:
-                    # Draw
-                    draws += 1
-            
-            if len(verses) > 0:
-                cur = self._db_conn.execute("SELECT outcome, white_player FROM matches WHERE enabled=1 AND black_player=? AND (" + (" OR ".join("white_player=?" for i in xrange(len(verses)))) + ")", tuple([i[0]] + verses))
+                verses = []
+        
+        cur = self._read_conn().cursor()
+        if len(verses) == 0 and since is None and until is None:
+            cur.row_factory = player_stats_row_factory
+            cur.execute(PLAYERS_WITH_STATS)
+        else:
+            cur.row_factory = player_row_factory(self._get_player_stats(None, verses, since, until))
+            cur.execute("SELECT id, first_name, last_name, grade FROM players WHERE deleted!=1 ORDER BY last_name, first_name")
+        return iter_rows(cur, batch_size)
+    
+    def _get_player_stats(self, ids=None, verses=[], since=None, until=None):
+        """Return a dict mapping player IDs (all players if "ids" is None) to tuples of (white_wins, white_losses, black_wins, black_losses, stalemates, draws, total), read from the player_stats table (or the head_to_head table if "verses" is specified), or counted in a single grouped pass over the matches table if there's a time window. Players without any matches may be left out."""
+        if ids is not None and len(ids) == 0:
+            return {}
+        
+        window, window_params = schema.time_window(since, until)
+        if len(verses) == 0 and not window:
+            where = ""
+            params = []
+            if ids is not None and len(ids) <= SQLITE_MAX_VARIABLES:
+                where = " WHERE player IN (" + ", ".join("?" for i in ids) + ")"
+                params = ids
+            cur = self._read_conn().execute("SELECT player, white_wins, white_losses, black_wins, black_losses, stalemates, draws, total FROM player_stats" + where, tuple(params))
+            stats = {}
+            for row in cur:
+                stats[row[0]] = tuple(row[1:])
+            return stats
+        
+        if len(verses) > 0 and not window:
+            where = "player_b IN (" + ", ".join("?" for i in verses) + ")"
+            params = list(verses)
+            if ids is not None and len(ids) + len(verses) <= SQLITE_MAX_VARIABLES:
+                where += " AND player_a IN (" + ", ".join("?" for i in ids) + ")"
+                params += ids
+            cur = self._read_conn().execute("SELECT player_a, SUM(white_wins), SUM(white_losses), SUM(wins - white_wins), SUM(losses - white_losses), SUM(stalemates), SUM(draws), SUM(wins + losses + stalemates + draws) FROM head_to_head WHERE " + where + " GROUP BY player_a", tuple(params))
+            stats = {}
+            for row in cur:
+                stats[row[0]] = tuple(row[1:])
+            return stats
+        
+        # Each match is counted once from white's point of view and once from black's point of view
+        # With a time window, both halves are range scans of the matches_timestamp index
+        white_where = "enabled=1" + window
+        black_where = "enabled=1" + window
+        white_params = list(window_params)
+        black_params = list(window_params)
+        if ids is not None and 2 * (len(ids) + len(verses) + len(window_params)) <= SQLITE_MAX_VARIABLES:
+            white_where += " AND white_player IN (" + ", ".join("?" for i in ids) + ")"
+            black_where += " AND black_player IN (" + ", ".join("?" for i in ids) + ")"
+            white_params += ids
+            black_params += ids
+        if len(verses) > 0:
+            white_where += " AND black_player IN (" + ", ".join("?" for i in verses) + ")"
+            black_where += " AND white_player IN (" + ", ".join("?" for i in verses) + ")"
+            white_params += verses
+            black_params += verses
+        
+        cur = self._read_conn().execute("""
+            SELECT player,
+                SUM(CASE WHEN is_white=1 AND outcome=0 THEN 1 ELSE 0 END),
+                SUM(CASE WHEN is_white=1 AND outcome=1 THEN 1 ELSE 0 END),
+                SUM(CASE WHEN is_white=0 AND outcome=1 THEN 1 ELSE 0 END),
+                SUM(CASE WHEN is_white=0 AND outcome=0 THEN 1 ELSE 0 END),
+                SUM(CASE WHEN outcome=2 THEN 1 ELSE 0 END),
+                SUM(CASE WHEN outcome IN (0, 1, 2) THEN 0 ELSE 1 END),
+                COUNT(*)
+            FROM (
+                SELECT white_player AS player, 1 AS is_white, outcome FROM matches WHERE """ + white_where + """
+                UNION ALL
+                SELECT black_player AS player, 0 AS is_white, outcome FROM matches WHERE """ + black_where + """
+            ) JOIN players ON players.id=player
+            GROUP BY player""", tuple(white_params + black_params))
+        
+        stats = {}
+        for row in cur:
+            stats[row[0]] = tuple(row[1:])
+        return stats
+    
+    @cached
+    def search_players(self, text, include_deleted=False, last_names_only=False):
+        """Return the players (with the same details as get_players) whose first name, last name, or full name starts with "text" (ignoring case), in order of name. If "last_names_only" is True, only last names are searched (for when only last names are shown). Deleted players are only included if "include_deleted" is True.
+        
+        Names are looked up in the indexed player_search table, so this stays fast however many players there are.
+        """
+        search, params = schema.search_prefix(text.strip(), last_names_only)
+        cur = self._read_conn().cursor()
+        cur.row_factory = player_stats_row_factory
+        return cur.execute(PLAYERS_WITH_STATS_SELECT + " WHERE id IN (" + search + ")" + (not include_deleted and " AND deleted!=1" or "") + " ORDER BY last_name, first_name", tuple(params)).fetchall()
+    
+    @cached
+    def get_head_to_head(self, a_ids, b_ids, since=None, until=None):
+        """Return the stats of each player in "a_ids" against each player in "b_ids", read from the head_to_head table (or counted from the matches with since <= timestamp < until, if "since" and/or "until" are specified).
+        
+        The result is a list of rows (one per player in "a_ids"), in which each row contains a list of stats (one per player in "b_ids", in the same format as the "stats" in get_players).
+        """
+        if not isinstance(a_ids, list):
+            a_ids = [a_ids]
+        if not isinstance(b_ids, list):
+            b_ids = [b_ids]
+        
+        if since is not None or until is not None:
+            found = self._get_head_to_head_window(set(a_ids), set(b_ids), since, until)
+            return [[make_stats(*found.get((a, b), (0, 0, 0, 0, 0, 0, 0))) for b in b_ids] for a in a_ids]
+        
+        found = {}
+        wanted_b = set(b_ids)
+        unique_a = list(set(a_ids))
+        # Filter on both sides in SQL when "b_ids" is small enough to leave room for chunks of "a_ids"
+        filter_b = len(wanted_b) <= SQLITE_MAX_VARIABLES / 2
+        chunk_size = filter_b and SQLITE_MAX_VARIABLES - len(wanted_b) or SQLITE_MAX_VARIABLES
+        for start in xrange(0, len(unique_a), chunk_size):
+            chunk = unique_a[start:start + chunk_size]
+            where = "player_a IN (" + ", ".join("?" for i in chunk) + ")"
+            params = chunk
+            if filter_b:
+                where += " AND player_b IN (" + ", ".join("?" for i in wanted_b) + ")"
+                params = chunk + list(wanted_b)
+            cur = self._read_conn().execute("SELECT player_a, player_b, white_wins, white_losses, wins - white_wins, losses - white_losses, stalemates, draws, wins + losses + stalemates + draws FROM head_to_head WHERE " + where, tuple(params))
+            for row in cur:
+                if row[1] in wanted_b:
+                    found[(row[0], row[1])] = row[2:]
+        
+        rows = []
+        for a in a_ids:
+            rows.append([make_stats(*found.get((a, b), (0, 0, 0, 0, 0, 0, 0))) for b in b_ids])
+        return rows
+    
+    def _get_head_to_head_window(self, a_ids, b_ids, since, until):
+        """Return a dict mapping (a, b) pairs (for players in the sets "a_ids" and "b_ids") to stats tuples (like _get_player_stats) for the matches with since <= timestamp < until."""
+        window, params = schema.time_window(since, until)
+        found = {}
+        def add(a, b, index, count):
+            if a in a_ids and b in b_ids:
+                stats = found.setdefault((a, b), [0, 0, 0, 0, 0, 0, 0])
+                stats[index] += count
+                stats[6] += count
+        
+        cur = self._read_conn().execute("SELECT white_player, black_player, outcome, COUNT(*) FROM matches WHERE enabled=1" + window + " GROUP BY white_player, black_player, outcome", tuple(params))
+        for white_player, black_player, outcome, count in cur:
+            if outcome == 0:
+                add(white_player, black_player, 0, count)
+                add(black_player, white_player, 3, count)
+            elif outcome == 1:
+                add(white_player, black_player, 1, count)
+                add(black_player, white_player, 2, count)
             else:
-                cur = self._db_conn.execute("SELECT outcome, white_player FROM matches WHERE enabled=1 AND black_player=?", (i[0],))
-            for match in cur.fetchall():
-                total += 1
-                if match[0] == 0:
-                    # White won
-                    black_losses += 1
-                elif match[0] == 1:
-                    # Black won
-                    black_wins += 1
-                elif match[0] == 2:
-                    # Stalemate
-                    stalemates += 1
-                else:
-                    # Draw
-                    draws += 1
-            returnitem["stats"] = {
-                "wins": white_wins + black_wins,
-                "white_wins": white_wins,
-                "black_wins": black_wins,
-                "losses": white_losses + black_losses,
-                "white_losses": white_losses,
-                "black_losses": black_losses,
-                "stalemates": stalemates,
-                "draws": draws,
-                "total": total
-            }
-            returnitems.append(Struct(returnitem))
-        return returnitems
+                index = outcome == 2 and 4 or 5
+                add(white_player, black_player, index, count)
+                add(black_player, white_player, index, count)
+        return found
     
-    def get_matches(self, ids=[], exclude_disabled=True):
-        """Get details for individual matches via their IDs, or get details for all matches if "ids" is empty. If "exclude_disabled" is False, disabled events will be included in results (only applies if "ids" is empty)."""
+    @cached
+    def get_matches(self, ids=[], exclude_disabled=True, since=None, until=None, with_players=False):
+        """Get details for individual matches via their IDs, or get details for all matches if "ids" is empty. If "exclude_disabled" is False, disabled events will be included in results. If "since" and/or "until" are specified, only matches with since <= timestamp < until are included. (These only apply if "ids" is empty.)
+        
+        If "with_players" is True, each match also has the names and grades of its players as "white" and "black" (deleted players included), read in the same query (this is much faster than looking up each match's players with get_players, which also works out their stats).
+        """
         if not isinstance(ids, list):
             if ids:
                 ids = [ids]
             else:
                 ids = []
         
-        items = []
+        cur = self._read_conn().cursor()
+        if with_players:
+            cur.row_factory = MatchWithPlayers.row_factory
+            select = MATCHES_WITH_PLAYERS + " WHERE "
+        else:
+            cur.row_factory = Match.row_factory
+            select = "SELECT id, enabled, timestamp, white_player, black_player, outcome FROM matches WHERE "
         if len(ids) == 0:
-            items = self._db_conn.execute("SELECT id, enabled, timestamp, white_player, black_player, outcome FROM matches " + (exclude_disabled and "WHERE enabled=1 " or "") + "ORDER BY timestamp").fetchall()
+            window, params = schema.time_window(since, until)
+            return cur.execute(select + (exclude_disabled and "matches.enabled=1" or "1") + window + " ORDER BY matches.timestamp", tuple(params)).fetchall()
         else:
-            items = []
-            for id in ids:
-                result = self._db_conn.execute("SELECT id, enabled, timestamp, white_player, black_player, outcome FROM matches WHERE id=?", (id,)).fetchone()
-                if result:
-                    items.append(result)
-        
-        returnitems = []
-        for i in items:
-            returnitem = {
-                "id": i[0],
-                "enabled": i[1],
-                "timestamp": i[2],
-                "white_player": i[3],
-                "black_player": i[4],
-                "outcome": i[5]
-            }
-            returnitems.append(Struct(returnitem))
-        return returnitems
+            return fetch_by_ids(cur, select + "matches.id IN ", ids)
+    
+    @cached
+    def get_match_summary(self, exclude_disabled=True, player_ids=None):
+        """Return a tuple of (number of matches, timestamp of the latest match or None), counted in one aggregate query instead of loading the matches. If "exclude_disabled" is False, disabled matches are counted too. If "player_ids" is a list of player IDs, only the matches that one of those players played in are counted."""
+        return tuple(self._read_conn().execute("SELECT COUNT(*), MAX(timestamp) FROM matches WHERE " + match_filter(self._read_conn(), exclude_disabled, player_ids)).fetchone())
+    
+    @cached
+    def get_match_page(self, offset=0, limit=100, exclude_disabled=True, player_ids=None):
+        """Return up to "limit" matches, starting at the "offset"th one (in order of timestamp), with the names and grades of their players as "white" and "black" (deleted players included). If "exclude_disabled" is False, disabled matches are included. If "player_ids" is a list of player IDs, only the matches that one of those players played in are included.
+        
+        get_match_summary (with the same "exclude_disabled" and "player_ids") gives the total number of matches, so a list of matches can be filled in a page at a time as it's scrolled.
+        """
+        cur = self._read_conn().cursor()
+        cur.row_factory = MatchWithPlayers.row_factory
+        # The page's IDs are found first, so the players are only joined for the matches on the page (and so that, with the matches_enabled_timestamp index, skipping to the offset only reads the index)
+        return cur.execute(MATCHES_WITH_PLAYERS + " WHERE matches.id IN (SELECT id FROM matches WHERE " + match_filter(self._read_conn(), exclude_disabled, player_ids) + " ORDER BY timestamp, id LIMIT ? OFFSET ?) ORDER BY matches.timestamp, matches.id", (limit, offset)).fetchall()
+    
+    def iter_matches(self, exclude_disabled=True, batch_size=1000, with_players=False):
+        """Generate the same details as get_matches for all matches (in order of timestamp), reading them from the database "batch_size" matches at a time instead of all at once. If "exclude_disabled" is False, disabled matches are included. If "with_players" is True, the players' names and grades are included (see get_matches).
+        
+        Don't write to the database through this instance while iterating (committing resets the open query).
+        """
+        cur = self._read_conn().cursor()
+        if with_players:
+            cur.row_factory = MatchWithPlayers.row_factory
+            cur.execute(MATCHES_WITH_PLAYERS + " " + (exclude_disabled and "WHERE matches.enabled=1 " or "") + "ORDER BY matches.timestamp")
+        else:
+            cur.row_factory = Match.row_factory
+            cur.execute("SELECT id, enabled, timestamp, white_player, black_player, outcome FROM matches " + (exclude_disabled and "WHERE enabled=1 " or "") + "ORDER BY timestamp")
+        return iter_rows(cur, batch_size)
+    
+    @cached
+    def search_matches(self, text, exclude_disabled=True, with_players=False, last_names_only=False):
+        """Return the matches (like get_matches, in order of timestamp) played by a player whose name starts with "text" (see search_players, including "last_names_only"; deleted players are included). If "exclude_disabled" is False, disabled matches are included. If "with_players" is True, the players' names and grades are included (see get_matches).
+        
+        The players are found in the player_search index (and, unless they played most of the matches, their matches in the matches_white and matches_black indexes).
+        """
+        search, params = schema.search_prefix(text.strip(), last_names_only)
+        player_ids = [row[0] for row in self._read_conn().execute(search, tuple(params))]
+        cur = self._read_conn().cursor()
+        if with_players:
+            cur.row_factory = MatchWithPlayers.row_factory
+            select = MATCHES_WITH_PLAYERS + " WHERE "
+        else:
+            cur.row_factory = Match.row_factory
+            select = "SELECT id, enabled, timestamp, white_player, black_player, outcome FROM matches WHERE "
+        return cur.execute(select + match_filter(self._read_conn(), exclude_disabled, player_ids) + " ORDER BY matches.timestamp").fetchall()
+    
+    @cached
+    def get_rankings(self, include_scores=False, method=None, since=None, until=None):
+        """Return a list of players (or a list of tuples (player ID, score) if include_scores==True) in ranked order, where "score" indicates a player's internal score (higher is better).
+        
+        If "method" is one of the rating methods in ratings.METHODS ("elo" or "glicko2"), players are ranked by their rating instead (and "score" is the rating).
+        
+        If "since" and/or "until" are specified, only the matches with since <= timestamp < until are counted (ratings start over from the beginning of the window).
+        """
+        if method is None:
+            return get_rankings(self, include_scores, since, until)
+        if since is not None or until is not None:
+            return ratings.get_rankings(self._read_conn(), method, include_scores, ratings.compute(self._read_conn(), method, since, until))
+        if not ratings.is_current(self._read_conn(), method):
+            if self.readonly:
+                # Can't store them, so work them out from scratch
+                return ratings.get_rankings(self._read_conn(), method, include_scores, ratings.compute(self._read_conn(), method))
+            self.update_ratings()
+        return ratings.get_rankings(self._read_conn(), method, include_scores)
     
-    def get_rankings(self, include_scores=False):
-        """Return a list of players (or a list of tuples (player ID, score) if include_scores==True) in ranked order, where "score" indicates a player's internal score (higher is better)."""
-        return get_rankings(self, include_scores)
+    def check_player_stats(self, repair=True):
+        """Check the player_stats summary table (which get_players reads its totals from) against the matches, and return a list of the IDs of the players whose totals were wrong. If "repair" is True and any were wrong, rebuild the table from scratch."""
+        bad_ids = schema.check_player_stats(self._read_conn())
+        if repair and bad_ids:
+            self.rebuild_player_stats()
+        return bad_ids
     
-    def get_grand_table(self, ids=[], full_names=True):
-        """Return a dict (Struct) containing "rows", "column_headers", and "row_headers", in which "rows" contains all the players and their scores against each of their opponents (represented by a list of rows, in which each row (list item) contains a list of column values for that row)."""
+    @writes
+    def rebuild_player_stats(self):
+        """Rebuild the player_stats summary table from the matches."""
+        schema.rebuild_player_stats(self._db_conn)
+        self._commit()
+    
+    @writes
+    def update_ratings(self):
+        """Bring the stored ratings (see the ratings module) up to date with the matches. get_rankings does this when it needs them, so this is only needed to do the work ahead of time (after many matches have been added or changed)."""
+        self._update_ratings()
+        self._commit()
+    
+    def _update_ratings(self):
+        for name in ratings.METHODS:
+            ratings.update(self._db_conn, name)
+    
+    @cached
+    def get_grand_table(self, ids=[], full_names=True, since=None, until=None):
+        """Return a dict (Struct) containing "rows", "column_headers", and "row_headers", in which "rows" contains all the players and their scores against each of their opponents (represented by a list of rows, in which each row (list item) contains a list of column values for that row). If "since" and/or "until" are specified, only the matches with since <= timestamp < until are counted."""
         if not isinstance(ids, list):
             if ids:
                 ids = [ids]
@@ -271,17 +714,37 @@ class mc(object):
         if not ids or len(ids) == 0:
             ids = all_ids
         
+        # Build the full score matrix (row player's score against column player) from one aggregate pass
+        index_of = dict((player_id, index) for index, player_id in enumerate(all_ids))
+        scores = [[0.0] * len(all_ids) for i in all_ids]
+        played = [[False] * len(all_ids) for i in all_ids]
+        window, params = schema.time_window(since, until)
+        cur = self._read_conn().execute("SELECT white_player, black_player, outcome, COUNT(*) FROM matches WHERE enabled=1" + window + " GROUP BY white_player, black_player, outcome", tuple(params))
+        for white_player, black_player, outcome, count in cur:
+            if white_player not in index_of or black_player not in index_of:
+                # Matches against deleted players don't show up in the table
+                continue
+            white_index = index_of[white_player]
+            black_index = index_of[black_player]
+            if outcome == 0:
+                scores[white_index][black_index] += count
+            elif outcome == 1:
+                scores[black_index][white_index] += count
+            else:
+                # Stalemates and draws are worth half a point to each player
+                scores[white_index][black_index] += count * 0.5
+                scores[black_index][white_index] += count * 0.5
+            played[white_index][black_index] = True
+            played[black_index][white_index] = True
+        
         rows = []
         column_totals = {}
         for id in ids:
             row = []
             total_score = 0
-            for index, player_id in enumerate(all_ids):
-                player = all_players[player_id]
-                player_data = self.get_players(id, player.id)[0]
-                score = player_data.stats.wins + player_data.stats.stalemates * 0.5 + player_data.stats.draws * 0.5
+            for index, score in enumerate(scores[index_of[id]]):
                 total_score += score
-                if player_data.stats.total > 0:
+                if played[index_of[id]][index]:
                     row.append(score)
                 else:
                     row.append(None)
@@ -317,39 +780,71 @@ class mc(object):
             "row_headers": row_headers
         })
     
-    def get_stats(self):
-        """Return an object/dict containing interesting stats."""
+    @cached
+    def get_stats(self, since=None, until=None, by_grade=False, by_month=False):
+        """Return an object/dict containing interesting stats (about the matches with since <= timestamp < until, if "since" and/or "until" are specified).
+        
+        If "by_grade" is True, it also contains "by_grade", which maps each grade to the wins, losses, stalemates, draws, and total games of the players in that grade. If "by_month" is True, it also contains "by_month", which maps each month ("YYYY-MM") to the same counts as "totals" for the matches in that month. Everything is counted in a single grouped pass over the matches.
+        """
         returning = {}
         
-        white = 0
-        black = 0
-        stalemate = 0
-        draw = 0
-        total = 0
-        matches = self.get_matches()
-        for match in matches:
-            total += 1
-            if match.outcome == 0:
-                white += 1
-            elif match.outcome == 1:
-                black += 1
-            elif match.outcome == 2:
-                stalemate += 1
+        columns = ["outcome"]
+        joins = ""
+        if by_grade:
+            columns += ["white.grade", "black.grade"]
+            joins = " LEFT JOIN players AS white ON white.id=white_player LEFT JOIN players AS black ON black.id=black_player"
+        if by_month:
+            columns.append("strftime('%Y-%m', timestamp, 'unixepoch', 'localtime')")
+        window, params = schema.time_window(since, until)
+        cur = self._read_conn().execute("SELECT " + ", ".join(columns) + ", COUNT(*) FROM matches" + joins + " WHERE enabled=1" + window + " GROUP BY " + ", ".join(columns), tuple(params))
+        
+        def add_match_counts(counts, outcome, count):
+            counts["matches"] += count
+            if outcome == 0:
+                counts["white_wins"] += count
+            elif outcome == 1:
+                counts["black_wins"] += count
+            elif outcome == 2:
+                counts["stalemates"] += count
+            else:
+                counts["draws"] += count
+        
+        def add_game_counts(counts, outcome, win, loss, count):
+            counts["games"] += count
+            if outcome == win:
+                counts["wins"] += count
+            elif outcome == loss:
+                counts["losses"] += count
+            elif outcome == 2:
+                counts["stalemates"] += count
             else:
-                draw += 1
-        returning["totals"] = {
-            "white_wins": white,
-            "black_wins": black,
-            "stalemates": stalemate,
-            "draws": draw,
-            "matches": total
-        }
+                counts["draws"] += count
+        
+        totals = {"white_wins": 0, "black_wins": 0, "stalemates": 0, "draws": 0, "matches": 0}
+        grades = {}
+        months = {}
+        for row in cur:
+            outcome = row[0]
+            count = row[-1]
+            add_match_counts(totals, outcome, count)
+            if by_grade:
+                for grade, win, loss in ((row[1], 0, 1), (row[2], 1, 0)):
+                    if grade not in grades:
+                        grades[grade] = {"wins": 0, "losses": 0, "stalemates": 0, "draws": 0, "games": 0}
+                    add_game_counts(grades[grade], outcome, win, loss, count)
+            if by_month:
+                if row[-2] not in months:
+                    months[row[-2]] = {"white_wins": 0, "black_wins": 0, "stalemates": 0, "draws": 0, "matches": 0}
+                add_match_counts(months[row[-2]], outcome, count)
+        
+        returning["totals"] = totals
+        total = totals["matches"]
         if total > 0:
             returning["outcomes"] = {
-                "white": float(white) / float(total),
-                "black": float(black) / float(total),
-                "stalemate": float(stalemate) / float(total),
-                "draw": float(draw) / float(total)
+                "white": float(totals["white_wins"]) / float(total),
+                "black": float(totals["black_wins"]) / float(total),
+                "stalemate": float(totals["stalemates"]) / float(total),
+                "draw": float(totals["draws"]) / float(total)
             }
         else:
             returning["outcomes"] = {
@@ -358,5 +853,14 @@ class mc(object):
                 "stalemate": 0.0,
                 "draw": 0.0
             }
+        if by_grade:
+            returning["by_grade"] = grades
+        if by_month:
+            returning["by_month"] = months
         
-        return Struct(returning)
\ No newline at end of file
+        return Struct(returning)
+
+# Public methods whose calls are timed when instrumentation is enabled
+INSTRUMENTED_METHODS = ["get_pref", "set_pref", "add_player", "add_players", "update_player", "remove_player", "add_match", "add_matches", "update_match", "remove_match", "get_players", "search_players", "get_head_to_head", "get_matches", "get_match_summary", "get_match_page", "search_matches", "get_rankings", "update_ratings", "check_player_stats", "rebuild_player_stats", "get_grand_table", "get_stats"]
+for _name in INSTRUMENTED_METHODS:
+    setattr(mc, _name, timed(_name, mc.__dict__[_name]))
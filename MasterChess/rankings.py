@@ -1,9 +1,9 @@
 from operator import itemgetter
 
-def get_rankings(mc, include_scores):
+def get_rankings(mc, include_scores, since=None, until=None):
     allstats = {}
     playerinfo = {}
-    for i in mc.get_players():
+    for i in mc.get_players(since=since, until=until):
         allstats[i.id] = i.stats
         playerinfo[i.id] = i
     
@@ -19,9 +19,10 @@ def get_rankings(mc, include_scores):
         player_scores[score].append(id)
     
     # If there are 2 or more players with the same score, we should compare the individual people
+    head_to_head = load_head_to_head(mc, [players for players in player_scores.itervalues() if len(players) >= 2], since, until)
     for score, players in player_scores.items():
         if len(players) >= 2:
-            new_player_list = compare(mc, players, playerinfo)
+            new_player_list = compare(head_to_head, players, playerinfo)
             if new_player_list != None:
                 base_score = score
                 for p in new_player_list:
@@ -44,30 +45,63 @@ def get_rankings(mc, include_scores):
     else:
         return [(i[0], i[1]) for i in player_list]
 
-def compare(mc, player_list, playerinfo, recursion_level=0):
+def load_head_to_head(mc, groups, since=None, until=None):
+    """Return a dict mapping each (player, opponent) pair within each list of players in "groups" to a tuple of (wins, losses, total) for player against opponent (only counting matches with since <= timestamp < until, if specified).
+    
+    Counting matches within a time window means going through all of them, so that's done once for all the groups.
+    """
+    head_to_head = {}
+    if since is None and until is None:
+        for players in groups:
+            for player, row in zip(players, mc.get_head_to_head(players, players)):
+                for opponent, stats in zip(players, row):
+                    head_to_head[(player, opponent)] = (stats.wins, stats.losses, stats.total)
+    elif groups:
+        wanted = set(player for players in groups for player in players)
+        found = mc._get_head_to_head_window(wanted, wanted, since, until)
+        for players in groups:
+            for player in players:
+                for opponent in players:
+                    white_wins, white_losses, black_wins, black_losses, stalemates, draws, total = found.get((player, opponent), (0, 0, 0, 0, 0, 0, 0))
+                    head_to_head[(player, opponent)] = (white_wins + black_wins, white_losses + black_losses, total)
+    return head_to_head
+
+def verses_stats(head_to_head, player, player_list):
+    """Return a tuple of (wins, losses, total) for "player" against all the players in "player_list"."""
+    wins = losses = total = 0
+    for opponent in player_list:
+        opponent_wins, opponent_losses, opponent_total = head_to_head[(player, opponent)]
+        wins += opponent_wins
+        losses += opponent_losses
+        total += opponent_total
+    return wins, losses, total
+
+def compare(head_to_head, player_list, playerinfo, recursion_level=0):
     """Compare 2 or more players and return a list of the players in ranked order, or None if no further ranking can be done.
     
+    "head_to_head" is the result of load_head_to_head for (at least) the players in "player_list", so no database lookups are needed.
+    
     Basically, perform magic.
     """
     if len(player_list) < 2:
         return player_list
     elif len(player_list) == 2:
         playerA, playerB = player_list
-        verses_stats = mc.get_players([playerA], [playerB])[0].stats
-        if verses_stats.wins > verses_stats.losses:
+        wins, losses, total = verses_stats(head_to_head, playerA, [playerB])
+        if wins > losses:
             return [playerA, playerB]
-        elif verses_stats.losses > verses_stats.wins:
+        elif losses > wins:
             return [playerB, playerA]
         else:
             return None
     else:
         player_scores = {}
         for player in player_list:
-            verses_stats = mc.get_players([player], player_list)[0].stats
+            wins, losses, total = verses_stats(head_to_head, player, player_list)
             score = 0.0
-            if verses_stats.total > 0:
-                winratio = float(verses_stats.wins) / float(verses_stats.total)
-                lossratio = float(verses_stats.losses) / float(verses_stats.total)
+            if total > 0:
+                winratio = float(wins) / float(total)
+                lossratio = float(losses) / float(total)
                 score = winratio - lossratio
             if score not in player_scores:
                 player_scores[score] = []
@@ -76,7 +110,7 @@ def compare(mc, player_list, playerinfo, recursion_level=0):
         # If there are still 2 or more players with the same score, we compare the individual people
         for score, players in player_scores.items():
             if len(players) == 2:
-                ranked_players = compare(mc, players, playerinfo, recursion_level)
+                ranked_players = compare(head_to_head, players, playerinfo, recursion_level)
                 if ranked_players != None:
                     better_player = ranked_players[0]
                     player_scores[score].remove(better_player)
@@ -84,7 +118,7 @@ def compare(mc, player_list, playerinfo, recursion_level=0):
                         player_scores[score + .0001] = []
                     player_scores[score + .0001].append(better_player)
             elif len(players) > 2 and recursion_level < 4:
-                new_player_list = compare(mc, players, playerinfo, recursion_level + 1)
+                new_player_list = compare(head_to_head, players, playerinfo, recursion_level + 1)
                 if new_player_list != None:
                     base_score = score
                     for p in new_player_list:
@@ -0,0 +1,232 @@
+"""
+Incremental player ratings (Elo and Glicko-2) for MasterChess databases
+
+For each method in METHODS, the "ratings" table has every player's current rating, and the "rating_history" table has every player's rating after each of their matches. Matches are applied in order of (timestamp, id), so a match added after the latest one only has to update the two players in it.
+
+Triggers on the matches table (see schema.create_ratings) note in "ratings_state" when a match that was already applied is changed or removed, or when a match is added before it. The next update then rewinds to just before that match (using rating_history) and replays the matches from there.
+"""
+
+import math
+
+import schema
+
+# Rating of a player who hasn't played any matches
+INITIAL_RATING = 1500.0
+
+# White's score for each "outcome" value (anything else is a draw)
+SCORES = {0: 1.0, 1: 0.0, 2: 0.5}
+
+class Elo(object):
+    """Elo ratings, with the same "k" factor for every player."""
+    
+    def __init__(self, k=32.0):
+        self.k = k
+    
+    def initial(self):
+        """Return the (rating, deviation, volatility) of a new player."""
+        return (INITIAL_RATING, None, None)
+    
+    def update(self, white, black, score):
+        """Return the new (rating, deviation, volatility) of white and black after a match in which white scored "score"."""
+        expected = 1.0 / (1.0 + 10.0 ** ((black[0] - white[0]) / 400.0))
+        change = self.k * (score - expected)
+        return (white[0] + change, None, None), (black[0] - change, None, None)
+
+class Glicko2(object):
+    """Glicko-2 ratings, with every match as its own rating period."""
+    
+    # Conversion between the Glicko and Glicko-2 scales
+    SCALE = 173.7178
+    
+    def __init__(self, deviation=350.0, volatility=0.06, tau=0.5):
+        self.deviation = deviation
+        self.volatility = volatility
+        self.tau = tau
+    
+    def initial(self):
+        """Return the (rating, deviation, volatility) of a new player."""
+        return (INITIAL_RATING, self.deviation, self.volatility)
+    
+    def update(self, white, black, score):
+        """Return the new (rating, deviation, volatility) of white and black after a match in which white scored "score"."""
+        return self._update(white, black, score), self._update(black, white, 1.0 - score)
+    
+    def _update(self, player, opponent, score):
+        # Step numbers are from Glickman's "Example of the Glicko-2 system"
+        mu = (player[0] - INITIAL_RATING) / self.SCALE
+        phi = player[1] / self.SCALE
+        sigma = player[2]
+        opponent_mu = (opponent[0] - INITIAL_RATING) / self.SCALE
+        opponent_phi = opponent[1] / self.SCALE
+        
+        # Steps 3 and 4
+        g = 1.0 / math.sqrt(1.0 + 3.0 * opponent_phi ** 2 / math.pi ** 2)
+        expected = 1.0 / (1.0 + math.exp(-g * (mu - opponent_mu)))
+        v = 1.0 / (g ** 2 * expected * (1.0 - expected))
+        delta = v * g * (score - expected)
+        
+        # Step 5: find the new volatility (Illinois algorithm)
+        a = math.log(sigma ** 2)
+        def f(x):
+            return math.exp(x) * (delta ** 2 - phi ** 2 - v - math.exp(x)) / (2.0 * (phi ** 2 + v + math.exp(x)) ** 2) - (x - a) / self.tau ** 2
+        
+        A = a
+        if delta ** 2 > phi ** 2 + v:
+            B = math.log(delta ** 2 - phi ** 2 - v)
+        else:
+            k = 1
+            while f(a - k * self.tau) < 0:
+                k += 1
+            B = a - k * self.tau
+        f_A = f(A)
+        f_B = f(B)
+        while abs(B - A) > 0.000001:
+            C = A + (A - B) * f_A / (f_B - f_A)
+            f_C = f(C)
+            if f_C * f_B <= 0:
+                A, f_A = B, f_B
+            else:
+                f_A /= 2.0
+            B, f_B = C, f_C
+        new_sigma = math.exp(A / 2.0)
+        
+        # Steps 6 to 8
+        phi_star = math.sqrt(phi ** 2 + new_sigma ** 2)
+        new_phi = 1.0 / math.sqrt(1.0 / phi_star ** 2 + 1.0 / v)
+        new_mu = mu + new_phi ** 2 * g * (score - expected)
+        return (new_mu * self.SCALE + INITIAL_RATING, new_phi * self.SCALE, new_sigma)
+
+METHODS = {
+    "elo": Elo(),
+    "glicko2": Glicko2()
+}
+
+def get_method(name):
+    """Return the rating method called "name" (one of the keys of METHODS)."""
+    if name not in METHODS:
+        raise ValueError("unknown rating method: %s" % name)
+    return METHODS[name]
+
+
+def replay(method, matches, states, load_state, history=None):
+    """Apply "matches" (an iterable of (id, timestamp, white_player, black_player, outcome) rows, in order) to "states" (a dict mapping player IDs to (rating, deviation, volatility) tuples), calling load_state(player) for players that aren't in "states" yet.
+    
+    If "history" is a list, a (match ID, timestamp, player, rating, deviation, volatility) row is added to it for both players of every match. Return the last match applied, or None if there weren't any.
+    """
+    last = None
+    for match in matches:
+        id, timestamp, white_player, black_player, outcome = match
+        for player in (white_player, black_player):
+            if player not in states:
+                states[player] = load_state(player)
+        white, black = method.update(states[white_player], states[black_player], SCORES.get(outcome, 0.5))
+        states[white_player] = white
+        states[black_player] = black
+        if history is not None:
+            history.append((id, timestamp, white_player) + white)
+            history.append((id, timestamp, black_player) + black)
+        last = match
+    return last
+
+def pending_matches(conn, last_timestamp, last_id):
+    """Return a cursor over the enabled matches after the match at (last_timestamp, last_id) (all of them if last_timestamp is None), in order."""
+    if last_timestamp is None:
+        return conn.execute("SELECT id, timestamp, white_player, black_player, outcome FROM matches WHERE enabled=1 ORDER BY timestamp, id")
+    # The "timestamp>=?" part lets SQLite use the matches_timestamp index
+    return conn.execute("SELECT id, timestamp, white_player, black_player, outcome FROM matches WHERE enabled=1 AND timestamp>=? AND (timestamp>? OR id>?) ORDER BY timestamp, id", (last_timestamp, last_timestamp, last_id))
+
+def get_state(conn, name):
+    """Return the (last_timestamp, last_id, replay_from) row from ratings_state for method "name", or None if it's never been updated."""
+    if not schema.has_table(conn, "ratings_state"):
+        return None
+    return conn.execute("SELECT last_timestamp, last_id, replay_from FROM ratings_state WHERE method=?", (name,)).fetchone()
+
+def is_current(conn, name):
+    """Return whether the stored ratings for method "name" include every enabled match (so they can be read as they are)."""
+    state = get_state(conn, name)
+    if state is None or state[2] is not None:
+        return False
+    return pending_matches(conn, state[0], state[1]).fetchone() is None
+
+def update(conn, name, batch_size=1000):
+    """Bring the stored ratings for method "name" up to date with the matches table. Nothing is committed, so this can be part of a write's transaction."""
+    if not schema.has_table(conn, "ratings_state"):
+        # Database hasn't been upgraded (see schema.migrate_3)
+        return
+    method = get_method(name)
+    state = get_state(conn, name)
+    if state is None:
+        conn.execute("INSERT INTO ratings_state(method) VALUES (?)", (name,))
+        state = (None, None, None)
+    last_timestamp, last_id, replay_from = state
+    
+    rewound = False
+    if last_timestamp is None or replay_from is not None:
+        # Rewind to just before "replay_from" (or all the way back to the start)
+        if last_timestamp is None:
+            conn.execute("DELETE FROM rating_history WHERE method=?", (name,))
+        else:
+            conn.execute("DELETE FROM rating_history WHERE method=? AND timestamp>=?", (name, replay_from))
+        # History is added in order, so each player's latest rating is their row with the highest rowid
+        conn.execute("DELETE FROM ratings WHERE method=?", (name,))
+        conn.execute("INSERT INTO ratings SELECT method, player, rating, deviation, volatility FROM rating_history WHERE rowid IN (SELECT MAX(rowid) FROM rating_history WHERE method=? GROUP BY player)", (name,))
+        last_timestamp, last_id = conn.execute("SELECT timestamp, match_id FROM rating_history WHERE method=? ORDER BY rowid DESC LIMIT 1", (name,)).fetchone() or (None, None)
+        rewound = True
+    
+    def load_state(player):
+        row = conn.execute("SELECT rating, deviation, volatility FROM ratings WHERE method=? AND player=?", (name, player)).fetchone()
+        return row and tuple(row) or method.initial()
+    
+    states = {}
+    last = None
+    cur = pending_matches(conn, last_timestamp, last_id)
+    while True:
+        matches = cur.fetchmany(batch_size)
+        if not matches:
+            break
+        history = []
+        last = replay(method, matches, states, load_state, history)
+        conn.executemany("INSERT INTO rating_history(method, match_id, timestamp, player, rating, deviation, volatility) VALUES (?, ?, ?, ?, ?, ?, ?)", [(name,) + row for row in history])
+    conn.executemany("INSERT OR REPLACE INTO ratings VALUES (?, ?, ?, ?, ?)", [(name, player) + values for player, values in states.iteritems()])
+    
+    if last is not None:
+        last_timestamp, last_id = last[1], last[0]
+    if last is not None or rewound:
+        conn.execute("UPDATE ratings_state SET last_timestamp=?, last_id=?, replay_from=NULL WHERE method=?", (last_timestamp, last_id, name))
+
+def append(conn, name):
+    """Apply the match that was just added to the stored ratings for method "name", but only if it's the only match they're missing (so this never takes more than a couple of queries). Anything else is left for the next update. Nothing is committed."""
+    state = get_state(conn, name)
+    if state is None or state[2] is not None:
+        return
+    if len(pending_matches(conn, state[0], state[1]).fetchmany(2)) == 1:
+        update(conn, name)
+
+def compute(conn, name, since=None, until=None):
+    """Return a dict mapping player IDs to (rating, deviation, volatility) tuples for method "name", computed from all the matches (or only the ones with since <= timestamp < until, if specified) without reading or writing the stored ratings."""
+    method = get_method(name)
+    states = {}
+    where, params = schema.time_window(since, until)
+    matches = conn.execute("SELECT id, timestamp, white_player, black_player, outcome FROM matches WHERE enabled=1" + where + " ORDER BY timestamp, id", tuple(params))
+    replay(method, matches, states, lambda player: method.initial())
+    return states
+
+
+def get_rankings(conn, name, include_scores, states=None):
+    """Return the players that aren't deleted in order of their rating for method "name" (or a list of tuples (player ID, rating) if include_scores==True). Ties are broken by grade, like rankings.get_rankings.
+    
+    The stored ratings are used, unless "states" is specified (see compute).
+    """
+    initial = get_method(name).initial()[0]
+    if states is None:
+        player_list = conn.execute("SELECT players.id, IFNULL(ratings.rating, ?) AS score FROM players LEFT JOIN ratings ON ratings.method=? AND ratings.player=players.id WHERE players.deleted!=1 ORDER BY score DESC, players.grade DESC", (initial, name)).fetchall()
+    else:
+        player_list = []
+        for id, grade in conn.execute("SELECT id, grade FROM players WHERE deleted!=1"):
+            player_list.append((id, (states.get(id) or (initial,))[0], grade))
+        player_list.sort(key=lambda player: (player[1], player[2]), reverse=True)
+    
+    if include_scores == False:
+        return [i[0] for i in player_list]
+    else:
+        return [(i[0], round(i[1], 1)) for i in player_list]
@@ -0,0 +1,155 @@
+class Record(object):
+    """A compact record with a fixed set of fields that can be accessed like an object or like a dict (like Struct, but without a dict per record)."""
+    
+    __slots__ = ()
+    
+    # Records are mutable (like Struct), so they can't be hashed
+    __hash__ = None
+    
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+    
+    def __contains__(self, key):
+        return key in self.__slots__
+    
+    def __iter__(self):
+        return iter(self.__slots__)
+    
+    def __len__(self):
+        return len(self.__slots__)
+    
+    def keys(self):
+        return list(self.__slots__)
+    
+    def values(self):
+        return [getattr(self, key) for key in self.__slots__]
+    
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+    
+    def iteritems(self):
+        for key in self.__slots__:
+            yield key, getattr(self, key)
+    
+    def get(self, key, default=None):
+        if key in self.__slots__:
+            return getattr(self, key)
+        return default
+    
+    def to_dict(self):
+        """Return a plain dict version of this record (and any records inside it)."""
+        return dict((key, isinstance(value, Record) and value.to_dict() or value) for key, value in self.iteritems())
+    
+    def copy(self):
+        """Return a copy of this record (and any records inside it)."""
+        return type(self)(*[isinstance(value, Record) and value.copy() or value for value in self.values()])
+    
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return type(self) == type(other) and self.values() == other.values()
+        elif isinstance(other, dict):
+            return dict(self.iteritems()) == other
+        return NotImplemented
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    
+    def __getstate__(self):
+        # Needed to pickle objects without a __dict__
+        return self.values()
+    
+    def __setstate__(self, state):
+        for key, value in zip(self.__slots__, state):
+            setattr(self, key, value)
+    
+    def __repr__(self):
+        # Same format as Struct
+        return "{" + ", ".join("%s: %s" % (key, repr(value)) for (key, value) in self.iteritems()) + "}"
+
+class Stats(Record):
+    """A player's stats (see mc.get_players)."""
+    
+    __slots__ = ("wins", "white_wins", "black_wins", "losses", "white_losses", "black_losses", "stalemates", "draws", "total")
+    
+    def __init__(self, wins, white_wins, black_wins, losses, white_losses, black_losses, stalemates, draws, total):
+        self.wins = wins
+        self.white_wins = white_wins
+        self.black_wins = black_wins
+        self.losses = losses
+        self.white_losses = white_losses
+        self.black_losses = black_losses
+        self.stalemates = stalemates
+        self.draws = draws
+        self.total = total
+
+class Player(Record):
+    """A player and their stats (see mc.get_players)."""
+    
+    __slots__ = ("id", "first_name", "last_name", "grade", "stats")
+    
+    def __init__(self, id, first_name, last_name, grade, stats):
+        self.id = id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.grade = grade
+        self.stats = stats
+
+class Match(Record):
+    """A match (see mc.get_matches)."""
+    
+    __slots__ = ("id", "enabled", "timestamp", "white_player", "black_player", "outcome")
+    
+    def __init__(self, id, enabled, timestamp, white_player, black_player, outcome):
+        self.id = id
+        self.enabled = enabled
+        self.timestamp = timestamp
+        self.white_player = white_player
+        self.black_player = black_player
+        self.outcome = outcome
+    
+    @staticmethod
+    def row_factory(cursor, row):
+        """sqlite3 row_factory that builds a Match from a (id, enabled, timestamp, white_player, black_player, outcome) row."""
+        return Match(*row)
+
+class MatchPlayer(Record):
+    """One of the players in a match, as given by mc.get_matches(with_players=True) and mc.get_match_page (deleted players included)."""
+    
+    __slots__ = ("id", "first_name", "last_name", "grade", "deleted")
+    
+    def __init__(self, id, first_name, last_name, grade, deleted):
+        self.id = id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.grade = grade
+        self.deleted = deleted
+
+class MatchWithPlayers(Record):
+    """A match and the details of both of its players (see mc.get_matches and mc.get_match_page)."""
+    
+    __slots__ = ("id", "enabled", "timestamp", "white_player", "black_player", "outcome", "white", "black")
+    
+    def __init__(self, id, enabled, timestamp, white_player, black_player, outcome, white, black):
+        self.id = id
+        self.enabled = enabled
+        self.timestamp = timestamp
+        self.white_player = white_player
+        self.black_player = black_player
+        self.outcome = outcome
+        self.white = white
+        self.black = black
+    
+    @staticmethod
+    def row_factory(cursor, row):
+        """sqlite3 row_factory that builds a MatchWithPlayers from a row of MATCHES_WITH_PLAYERS in mc (the match's columns, then id, first_name, last_name, grade, and deleted for the white and black players)."""
+        return MatchWithPlayers(row[0], row[1], row[2], row[3], row[4], row[5], MatchPlayer(row[3], *row[6:10]), MatchPlayer(row[4], *row[10:14]))
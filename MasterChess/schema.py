@@ -0,0 +1,314 @@
+"""
+Database schema and migrations for MasterChess databases
+
+The schema version of a database is stored in its "user_version" pragma. Each function in MIGRATIONS upgrades a database by one version, so opening an up-to-date database only costs one version check.
+"""
+
+import sqlite3, os, urllib
+
+
+def migrate_1(conn):
+    """Create the base tables and the head_to_head table."""
+    conn.execute("CREATE TABLE IF NOT EXISTS 'players' (id INTEGER PRIMARY KEY, deleted INTEGER, first_name TEXT, last_name TEXT, grade INTEGER);")
+    conn.execute("CREATE TABLE IF NOT EXISTS 'matches' (id INTEGER PRIMARY KEY, enabled INTEGER, timestamp INTEGER, white_player INTEGER, black_player INTEGER, outcome INTEGER);")
+    conn.execute("CREATE TABLE IF NOT EXISTS 'prefs' (name TEXT UNIQUE NOT NULL, value TEXT);")
+    
+    if not has_table(conn, "head_to_head"):
+        create_head_to_head(conn)
+
+def migrate_2(conn):
+    """Add indexes for looking up a player's matches, sorting matches by time, and listing players that aren't deleted."""
+    conn.execute("CREATE INDEX IF NOT EXISTS 'matches_white' ON matches (white_player, enabled, outcome);")
+    conn.execute("CREATE INDEX IF NOT EXISTS 'matches_black' ON matches (black_player, enabled, outcome);")
+    conn.execute("CREATE INDEX IF NOT EXISTS 'matches_timestamp' ON matches (timestamp);")
+    conn.execute("CREATE INDEX IF NOT EXISTS 'players_active' ON players (last_name, first_name) WHERE deleted!=1;")
+
+def migrate_3(conn):
+    """Create the ratings tables (which are filled in by the ratings module the first time they're needed)."""
+    create_ratings(conn)
+
+def migrate_4(conn):
+    """Create the player_stats table."""
+    if not has_table(conn, "player_stats"):
+        create_player_stats(conn)
+
+def migrate_5(conn):
+    """Add an index for paging through the enabled matches in order of time (see mc.get_match_page)."""
+    conn.execute("CREATE INDEX IF NOT EXISTS 'matches_enabled_timestamp' ON matches (enabled, timestamp);")
+
+def migrate_6(conn):
+    """Create the player_search table."""
+    if not has_table(conn, "player_search"):
+        create_player_search(conn)
+
+# MIGRATIONS[i] upgrades a database from version i to version i + 1
+MIGRATIONS = [migrate_1, migrate_2, migrate_3, migrate_4, migrate_5, migrate_6]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_version(conn):
+    """Return the schema version of the database in "conn"."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def upgrade(conn):
+    """Bring the database in "conn" up to SCHEMA_VERSION, running whichever migrations it's missing.
+    
+    Each migration runs in one transaction with its "user_version" change, so an upgrade that's interrupted leaves the database at the last version that was finished, and the next upgrade carries on from there.
+    """
+    version = get_version(conn)
+    if version > SCHEMA_VERSION:
+        raise sqlite3.DatabaseError("database schema version %d is newer than this version of MasterChess supports (%d)" % (version, SCHEMA_VERSION))
+    if version == SCHEMA_VERSION:
+        return
+    
+    # Python's sqlite3 commits before every CREATE (and PRAGMA) statement unless it's left to us to begin and end transactions
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        while True:
+            # IMMEDIATE, so another process that's upgrading at the same time waits for us (and then finds the new version)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = get_version(conn)
+                if version >= SCHEMA_VERSION:
+                    conn.execute("COMMIT")
+                    break
+                MIGRATIONS[version](conn)
+                conn.execute("PRAGMA user_version=%d" % (version + 1))
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.isolation_level = isolation_level
+
+
+def has_table(conn, name):
+    """Return whether the database in "conn" has a table called "name"."""
+    return len(conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (name,)).fetchall()) > 0
+
+def time_window(since=None, until=None):
+    """Return a tuple of (SQL, parameters) to add to a "WHERE" clause on the matches table to only include matches with since <= timestamp < until ("since" and "until" are optional)."""
+    sql = ""
+    params = []
+    if since is not None:
+        sql += " AND timestamp>=?"
+        params.append(since)
+    if until is not None:
+        sql += " AND timestamp<?"
+        params.append(until)
+    return sql, params
+
+def prepare_readonly(conn):
+    """Make a database opened read-only usable even if it hasn't been upgraded to SCHEMA_VERSION yet, by building temporary (in-memory, for this connection only) versions of any derived tables it's missing. The file itself is never touched."""
+    if not has_table(conn, "head_to_head"):
+        create_head_to_head(conn, temporary=True)
+    if not has_table(conn, "player_stats"):
+        create_player_stats(conn, temporary=True)
+    if not has_table(conn, "player_search"):
+        create_player_search(conn, temporary=True)
+
+def connect_readonly(path, immutable=False, factory=sqlite3.Connection):
+    """Return a connection (of class "factory") that can only read the database at "path" (which must already exist).
+    
+    If "immutable" is True, SQLite is told that nobody will change the file while it's open, so it doesn't take any locks at all.
+    """
+    if not os.path.exists(path):
+        raise sqlite3.OperationalError("unable to open database file")
+    uri = "file:" + urllib.pathname2url(os.path.abspath(path)) + "?mode=ro" + (immutable and "&immutable=1" or "")
+    try:
+        # Python 3.4+
+        conn = sqlite3.connect(uri, uri=True, factory=factory)
+    except TypeError:
+        # Older Pythons pass the name straight to SQLite, which only understands URIs if it was built with them enabled
+        options = [i[0] for i in sqlite3.connect(":memory:").execute("PRAGMA compile_options")]
+        if "USE_URI" in options:
+            conn = sqlite3.connect(uri, factory=factory)
+        else:
+            conn = sqlite3.connect(path, factory=factory)
+    prepare_readonly(conn)
+    # In case we couldn't use a "mode=ro" URI, this refuses writes too
+    conn.execute("PRAGMA query_only=ON")
+    return conn
+
+def head_to_head_trigger(name, event, row, sign):
+    """Return the SQL for a trigger that adds (sign "+") or subtracts (sign "-") the match in "row" (NEW or OLD) to/from the head_to_head table."""
+    def count(outcome):
+        if outcome is None:
+            # Anything that isn't a win, loss, or stalemate is a draw
+            return "(CASE WHEN %s.outcome IN (0, 1, 2) THEN 0 ELSE 1 END)" % row
+        return "(CASE WHEN %s.outcome=%d THEN 1 ELSE 0 END)" % (row, outcome)
+    
+    def update(player_a, player_b, win, loss, is_white):
+        sets = [
+            "wins=wins%s%s" % (sign, count(win)),
+            "losses=losses%s%s" % (sign, count(loss)),
+            "stalemates=stalemates%s%s" % (sign, count(2)),
+            "draws=draws%s%s" % (sign, count(None))
+        ]
+        if is_white:
+            sets += [
+                "white_wins=white_wins%s%s" % (sign, count(win)),
+                "white_losses=white_losses%s%s" % (sign, count(loss))
+            ]
+        return "UPDATE head_to_head SET %s WHERE player_a=%s.%s AND player_b=%s.%s;" % (", ".join(sets), row, player_a, row, player_b)
+    
+    return """CREATE TRIGGER IF NOT EXISTS %s AFTER %s ON matches WHEN %s.enabled=1
+BEGIN
+    INSERT OR IGNORE INTO head_to_head VALUES (%s.white_player, %s.black_player, 0, 0, 0, 0, 0, 0);
+    INSERT OR IGNORE INTO head_to_head VALUES (%s.black_player, %s.white_player, 0, 0, 0, 0, 0, 0);
+    %s
+    %s
+END;""" % (name, event, row, row, row, row, row,
+           update("white_player", "black_player", 0, 1, True),
+           update("black_player", "white_player", 1, 0, False))
+
+def create_head_to_head(conn, temporary=False):
+    """Create the head_to_head table (with the triggers that keep it up to date) and fill it from the existing matches.
+    
+    For every pair of players, head_to_head contains player_a's wins, losses, stalemates, and draws against player_b (and the wins and losses when player_a was white). Only enabled matches are counted.
+    
+    If "temporary" is True, create it as a temporary table (without triggers) that only exists for this connection.
+    """
+    conn.execute("CREATE " + (temporary and "TEMP " or "") + "TABLE IF NOT EXISTS 'head_to_head' (player_a INTEGER NOT NULL, player_b INTEGER NOT NULL, wins INTEGER NOT NULL, losses INTEGER NOT NULL, stalemates INTEGER NOT NULL, draws INTEGER NOT NULL, white_wins INTEGER NOT NULL, white_losses INTEGER NOT NULL, PRIMARY KEY (player_a, player_b));")
+    if not temporary:
+        conn.execute(head_to_head_trigger("head_to_head_insert", "INSERT", "NEW", "+"))
+        conn.execute(head_to_head_trigger("head_to_head_delete", "DELETE", "OLD", "-"))
+        conn.execute(head_to_head_trigger("head_to_head_update_old", "UPDATE OF enabled, white_player, black_player, outcome", "OLD", "-"))
+        conn.execute(head_to_head_trigger("head_to_head_update_new", "UPDATE OF enabled, white_player, black_player, outcome", "NEW", "+"))
+    conn.execute("""
+        INSERT INTO head_to_head
+        SELECT player_a, player_b,
+            SUM(CASE WHEN outcome=win THEN 1 ELSE 0 END),
+            SUM(CASE WHEN outcome=loss THEN 1 ELSE 0 END),
+            SUM(CASE WHEN outcome=2 THEN 1 ELSE 0 END),
+            SUM(CASE WHEN outcome IN (0, 1, 2) THEN 0 ELSE 1 END),
+            SUM(CASE WHEN is_white=1 AND outcome=win THEN 1 ELSE 0 END),
+            SUM(CASE WHEN is_white=1 AND outcome=loss THEN 1 ELSE 0 END)
+        FROM (
+            SELECT white_player AS player_a, black_player AS player_b, 1 AS is_white, 0 AS win, 1 AS loss, outcome FROM matches WHERE enabled=1
+            UNION ALL
+            SELECT black_player AS player_a, white_player AS player_b, 0 AS is_white, 1 AS win, 0 AS loss, outcome FROM matches WHERE enabled=1
+        )
+        GROUP BY player_a, player_b;""")
+
+def create_ratings(conn):
+    """Create the ratings, rating_history, and ratings_state tables used by the ratings module, with the triggers that tell it when matches it has already counted are changed.
+    
+    For each rating method, "ratings" has every player's current rating, "rating_history" has every player's rating after each of their matches, and "ratings_state" has the (timestamp, id) of the last match counted and the timestamp to replay from ("replay_from", NULL unless an earlier match was changed).
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS 'ratings' (method TEXT NOT NULL, player INTEGER NOT NULL, rating REAL NOT NULL, deviation REAL, volatility REAL, PRIMARY KEY (method, player));")
+    conn.execute("CREATE TABLE IF NOT EXISTS 'rating_history' (method TEXT NOT NULL, match_id INTEGER NOT NULL, timestamp INTEGER, player INTEGER NOT NULL, rating REAL NOT NULL, deviation REAL, volatility REAL);")
+    conn.execute("CREATE INDEX IF NOT EXISTS 'rating_history_timestamp' ON rating_history (method, timestamp);")
+    conn.execute("CREATE INDEX IF NOT EXISTS 'rating_history_player' ON rating_history (method, player);")
+    conn.execute("CREATE TABLE IF NOT EXISTS 'ratings_state' (method TEXT PRIMARY KEY, last_timestamp INTEGER, last_id INTEGER, replay_from INTEGER);")
+    
+    def trigger(name, event, when, timestamp, where):
+        return """CREATE TRIGGER IF NOT EXISTS %s AFTER %s ON matches WHEN %s
+BEGIN
+    UPDATE ratings_state SET replay_from=MIN(IFNULL(replay_from, %s), %s) WHERE %s;
+END;""" % (name, event, when, timestamp, timestamp, where)
+
+    # New matches after the last one counted are picked up without replaying anything
+    conn.execute(trigger("ratings_insert", "INSERT", "NEW.enabled=1", "NEW.timestamp", "NEW.timestamp<last_timestamp OR (NEW.timestamp=last_timestamp AND NEW.id<last_id)"))
+    conn.execute(trigger("ratings_delete", "DELETE", "OLD.enabled=1", "OLD.timestamp", "OLD.timestamp<=last_timestamp"))
+    conn.execute(trigger("ratings_update", "UPDATE OF enabled, timestamp, white_player, black_player, outcome", "OLD.enabled=1 OR NEW.enabled=1", "MIN(OLD.timestamp, NEW.timestamp)", "MIN(OLD.timestamp, NEW.timestamp)<=last_timestamp"))
+
+# Each player's totals (like the "stats" of mc.get_players), counted from the enabled matches
+PLAYER_STATS_SELECT = """
+    SELECT player,
+        SUM(CASE WHEN is_white=1 AND outcome=0 THEN 1 ELSE 0 END),
+        SUM(CASE WHEN is_white=1 AND outcome=1 THEN 1 ELSE 0 END),
+        SUM(CASE WHEN is_white=0 AND outcome=1 THEN 1 ELSE 0 END),
+        SUM(CASE WHEN is_white=0 AND outcome=0 THEN 1 ELSE 0 END),
+        SUM(CASE WHEN outcome=2 THEN 1 ELSE 0 END),
+        SUM(CASE WHEN outcome IN (0, 1, 2) THEN 0 ELSE 1 END),
+        COUNT(*)
+    FROM (
+        SELECT white_player AS player, 1 AS is_white, outcome FROM matches WHERE enabled=1
+        UNION ALL
+        SELECT black_player AS player, 0 AS is_white, outcome FROM matches WHERE enabled=1
+    )
+    GROUP BY player"""
+
+def player_stats_trigger(name, event, row, sign):
+    """Return the SQL for a trigger that adds (sign "+") or subtracts (sign "-") the match in "row" (NEW or OLD) to/from the player_stats table."""
+    def count(outcome):
+        if outcome is None:
+            return "(CASE WHEN %s.outcome IN (0, 1, 2) THEN 0 ELSE 1 END)" % row
+        return "(CASE WHEN %s.outcome=%d THEN 1 ELSE 0 END)" % (row, outcome)
+    
+    def update(player, color, win, loss):
+        sets = [
+            "%s_wins=%s_wins%s%s" % (color, color, sign, count(win)),
+            "%s_losses=%s_losses%s%s" % (color, color, sign, count(loss)),
+            "stalemates=stalemates%s%s" % (sign, count(2)),
+            "draws=draws%s%s" % (sign, count(None)),
+            "total=total%s1" % sign
+        ]
+        return "UPDATE player_stats SET %s WHERE player=%s.%s;" % (", ".join(sets), row, player)
+    
+    return """CREATE TRIGGER IF NOT EXISTS %s AFTER %s ON matches WHEN %s.enabled=1
+BEGIN
+    INSERT OR IGNORE INTO player_stats VALUES (%s.white_player, 0, 0, 0, 0, 0, 0, 0);
+    INSERT OR IGNORE INTO player_stats VALUES (%s.black_player, 0, 0, 0, 0, 0, 0, 0);
+    %s
+    %s
+END;""" % (name, event, row, row, row,
+           update("white_player", "white", 0, 1),
+           update("black_player", "black", 1, 0))
+
+def create_player_stats(conn, temporary=False):
+    """Create the player_stats table (with the triggers that keep it up to date) and fill it from the existing matches.
+    
+    player_stats has a row for every player who has played an enabled match, with the same totals as the "stats" of mc.get_players. (Rows aren't removed when a player's matches are, so some rows may be all zeros.)
+    
+    If "temporary" is True, create it as a temporary table (without triggers) that only exists for this connection.
+    """
+    conn.execute("CREATE " + (temporary and "TEMP " or "") + "TABLE IF NOT EXISTS 'player_stats' (player INTEGER PRIMARY KEY, white_wins INTEGER NOT NULL, white_losses INTEGER NOT NULL, black_wins INTEGER NOT NULL, black_losses INTEGER NOT NULL, stalemates INTEGER NOT NULL, draws INTEGER NOT NULL, total INTEGER NOT NULL);")
+    if not temporary:
+        conn.execute(player_stats_trigger("player_stats_insert", "INSERT", "NEW", "+"))
+        conn.execute(player_stats_trigger("player_stats_delete", "DELETE", "OLD", "-"))
+        conn.execute(player_stats_trigger("player_stats_update_old", "UPDATE OF enabled, white_player, black_player, outcome", "OLD", "-"))
+        conn.execute(player_stats_trigger("player_stats_update_new", "UPDATE OF enabled, white_player, black_player, outcome", "NEW", "+"))
+    conn.execute("INSERT INTO player_stats " + PLAYER_STATS_SELECT)
+
+def check_player_stats(conn):
+    """Return a list of the IDs of the players whose row in player_stats doesn't match their matches."""
+    stored = "SELECT * FROM player_stats WHERE white_wins!=0 OR white_losses!=0 OR black_wins!=0 OR black_losses!=0 OR stalemates!=0 OR draws!=0 OR total!=0"
+    cur = conn.execute("SELECT player FROM (" + PLAYER_STATS_SELECT + " EXCEPT " + stored + ") UNION SELECT player FROM (" + stored + " EXCEPT " + PLAYER_STATS_SELECT + ")")
+    return [row[0] for row in cur]
+
+def rebuild_player_stats(conn):
+    """Refill the player_stats table from scratch (without committing)."""
+    conn.execute("DELETE FROM player_stats")
+    conn.execute("INSERT INTO player_stats " + PLAYER_STATS_SELECT)
+
+def player_search_terms(first_name, last_name):
+    """Return the (field, term) pairs that player_search has for a player with these names: their first name, last name, and full name, in lowercase. Python does the lowercasing (SQLite's lower() only knows ASCII letters), so the terms are kept up to date by the mc write methods instead of by triggers."""
+    first_name = first_name or u""
+    last_name = last_name or u""
+    return [("first", first_name.lower()), ("last", last_name.lower()), ("full", (first_name + u" " + last_name).lower())]
+
+def update_player_search(conn, players):
+    """Replace the player_search rows for "players" (an iterable of (id, first_name, last_name) rows) without committing."""
+    players = list(players)
+    conn.executemany("DELETE FROM player_search WHERE player=?", [(player[0],) for player in players])
+    conn.executemany("INSERT INTO player_search VALUES (?, ?, ?)", [(term, field, player[0]) for player in players for field, term in player_search_terms(player[1], player[2])])
+
+def create_player_search(conn, temporary=False):
+    """Create the player_search table and fill it from the existing players.
+    
+    player_search has a row for each of every player's search terms (see player_search_terms), deleted players included, so players can be found by the start of their name with an index range (see search_prefix).
+    
+    If "temporary" is True, create it as a temporary table that only exists for this connection.
+    """
+    conn.execute("CREATE " + (temporary and "TEMP " or "") + "TABLE IF NOT EXISTS 'player_search' (term TEXT NOT NULL, field TEXT NOT NULL, player INTEGER NOT NULL);")
+    conn.execute("CREATE INDEX IF NOT EXISTS 'player_search_term' ON player_search (term, field, player);")
+    conn.execute("CREATE INDEX IF NOT EXISTS 'player_search_player' ON player_search (player);")
+    update_player_search(conn, conn.execute("SELECT id, first_name, last_name FROM players").fetchall())
+
+def search_prefix(text, last_names_only=False):
+    """Return a tuple of (SQL, parameters) for a subquery that selects the IDs of the players (deleted players included) with a search term that starts with "text" (ignoring case). If "last_names_only" is True, only last names are searched."""
+    # Everything that starts with the prefix sorts between it and the prefix followed by the highest character there is
+    return "SELECT player FROM player_search WHERE term>=? AND term<? || char(1114111)" + (last_names_only and " AND field='last'" or ""), [text.lower(), text.lower()]
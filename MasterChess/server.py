@@ -0,0 +1,126 @@
+"""
+HTTP JSON service for MasterChess databases
+
+Serves (read-only) JSON for these paths:
+    /players        mc.get_players()
+    /matches        mc.get_matches()
+    /grand_table    mc.get_grand_table()
+    /rankings       mc.get_rankings(include_scores=True)
+    /stats          mc.get_stats()
+
+Every response has an ETag based on the database's data version, so clients that send it back in If-None-Match get a "304 Not Modified" (without anything being recomputed) until the database changes. Requests are handled by a fixed pool of worker threads.
+
+Usage from the command line:
+    python -m MasterChess.server database.mcdb [port] [workers]
+"""
+
+import sys, time, threading, Queue, urlparse, BaseHTTPServer
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from records import Record
+
+ENDPOINTS = {
+    "/players": lambda mc: mc.get_players(),
+    "/matches": lambda mc: mc.get_matches(),
+    "/grand_table": lambda mc: mc.get_grand_table(),
+    "/rankings": lambda mc: mc.get_rankings(True),
+    "/stats": lambda mc: mc.get_stats()
+}
+
+def to_json(value):
+    """Return "value" (which may contain records) as a JSON string."""
+    return json.dumps(value, default=lambda obj: isinstance(obj, Record) and obj.to_dict() or repr(obj))
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles GET requests for the paths in ENDPOINTS."""
+    
+    def do_GET(self):
+        path = urlparse.urlparse(self.path)[2].rstrip("/")
+        if path not in ENDPOINTS:
+            self.send_json(404, to_json({"error": "not found"}))
+            return
+        
+        etag = self.server.get_etag()
+        if etag in [i.strip() for i in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        
+        try:
+            body = to_json(ENDPOINTS[path](self.server.mc))
+        except:
+            exc_type, exc_value = sys.exc_info()[:2]
+            self.send_json(500, to_json({"error": "%s: %s" % (exc_type.__name__, exc_value)}))
+            return
+        self.send_json(200, body, etag)
+    
+    def send_json(self, code, body, etag=None):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+            # Clients may keep the response, but have to check with us before using it
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class MCServer(BaseHTTPServer.HTTPServer):
+    """HTTP server for "mc_instance" (which should be a threaded_mc, since requests are handled by "workers" threads)."""
+    
+    def __init__(self, mc_instance, address=("127.0.0.1", 8000), workers=4, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.mc = mc_instance
+        self.verbose = verbose
+        # data_version starts over whenever the database is opened again, so ETags from before a restart must not match
+        self._etag_prefix = "%x" % int(time.time() * 1000)
+        self._requests = Queue.Queue()
+        self._workers = []
+        for i in xrange(workers):
+            worker = threading.Thread(target=self._work)
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+    
+    def get_etag(self):
+        """Return the ETag for the current version of the database."""
+        return '"%s-%s"' % (self._etag_prefix, "-".join(str(i) for i in self.mc.get_data_version()))
+    
+    def process_request(self, request, client_address):
+        # Hand the request to the worker pool instead of handling it in the serving thread
+        self._requests.put((request, client_address))
+    
+    def _work(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        from MasterChess import open_database
+        mc_instance = open_database(sys.argv[1], threaded=True)
+        if mc_instance:
+            mc_instance.enable_cache()
+            port = len(sys.argv) > 2 and int(sys.argv[2]) or 8000
+            workers = len(sys.argv) > 3 and int(sys.argv[3]) or 4
+            server = MCServer(mc_instance, ("", port), workers, verbose=True)
+            print "Serving %s on port %d" % (sys.argv[1], server.server_address[1])
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    else:
+        print >> sys.stderr, "Usage: python -m MasterChess.server database.mcdb [port] [workers]"
@@ -0,0 +1,72 @@
+import sqlite3, threading, sys
+
+from mc import mc
+from instrument import InstrumentedConnection
+
+class threaded_mc(mc):
+    """MasterChess class that can be shared between threads (and used alongside other processes).
+    
+    The database is switched to WAL mode, so readers don't block behind writers. Each thread gets its own connection for reading (closed after the thread finishes, the next time a connection is opened), and all writes go through one writer connection (one thread at a time). Connections wait up to "busy_timeout" seconds for locks held by other processes instead of failing with "database is locked".
+    """
+    
+    def __init__(self, db_path, out=sys.stdout, busy_timeout=30.0):
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._read_conns = []
+        self._read_conns_lock = threading.Lock()
+        mc.__init__(self, db_path)
+        self._db_conn.execute("PRAGMA journal_mode=WAL")
+    
+    def _connect(self):
+        # Connections are used (and closed in uninit) from other threads than the one that opened them; the locks here make sure only one thread uses each at a time
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, check_same_thread=False, factory=InstrumentedConnection)
+        conn.instrumentation = self._instrumentation
+        conn.execute("PRAGMA busy_timeout=%d" % int(self.busy_timeout * 1000))
+        return conn
+    
+    def _read_conn(self):
+        if self._transaction_thread is threading.currentThread():
+            # Inside a transaction, read what it has written so far (which isn't committed yet)
+            return self._db_conn
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            self._read_conns_lock.acquire()
+            try:
+                self._close_dead_conns()
+                self._read_conns.append((threading.currentThread(), conn))
+            finally:
+                self._read_conns_lock.release()
+        return conn
+    
+    def _close_dead_conns(self):
+        """Close the read connections of threads that have finished (so short-lived threads don't leave connections open). Must be called with _read_conns_lock held."""
+        alive = []
+        for thread, conn in self._read_conns:
+            if thread.isAlive():
+                alive.append((thread, conn))
+            else:
+                try:
+                    conn.close()
+                except:
+                    pass
+        self._read_conns = alive
+    
+    def _reads_uncommitted(self):
+        # Only the thread holding the transaction reads through the writing connection
+        return self._transaction_thread is threading.currentThread()
+    
+    def uninit(self):
+        if self.isinit:
+            self._read_conns_lock.acquire()
+            try:
+                for thread, conn in self._read_conns:
+                    try:
+                        conn.close()
+                    except:
+                        pass
+                self._read_conns = []
+            finally:
+                self._read_conns_lock.release()
+        mc.uninit(self)
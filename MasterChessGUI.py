@@ -605,6 +605,94 @@ class PropertiesDialog(wx.Dialog):
             self.returnref["returned_data"] = data
             self.Destroy()
 
+class MatchesList(wx.ListCtrl):
+    """Virtual list of matches, which reads the matches from the database a page at a time as they're scrolled into view (see mc.get_match_page)."""
+    
+    PAGE_SIZE = 100
+    # Pages kept in memory at once
+    MAX_PAGES = 20
+    
+    def __init__(self, parent, mc):
+        wx.ListCtrl.__init__(self, parent, style=wx.LC_REPORT | wx.LC_HRULES | wx.LC_VIRTUAL)
+        self.mc = mc
+        self.exclude_disabled = True
+        self.player_ids = None
+        self.last_names = False
+        self.colorize = True
+        self.pages = {}
+        
+        # Colors for white victories, black victories, and everything else (and a little lighter for disabled matches)
+        self.attrs = {}
+        for enabled, diff in [(True, 0), (False, 10)]:
+            for outcome, background, foreground in [(0, 245, wx.BLACK), (1, 0, wx.WHITE), (None, 190, wx.BLACK)]:
+                attr = wx.ListItemAttr()
+                attr.SetBackgroundColour((background + diff, background + diff, background + diff))
+                attr.SetTextColour(foreground)
+                self.attrs[(outcome, enabled)] = attr
+    
+    def set_matches(self, exclude_disabled, player_ids, last_names, colorize):
+        """Show the matches that get_match_page gives for "exclude_disabled" and "player_ids", with players' names shown according to "last_names"."""
+        self.exclude_disabled = exclude_disabled
+        self.player_ids = player_ids
+        self.last_names = last_names
+        self.colorize = colorize
+        self.refresh()
+    
+    def refresh(self):
+        """Read the matches from the database again (after they've been changed)."""
+        self.pages = {}
+        self.SetItemCount(self.mc.get_match_summary(self.exclude_disabled, self.player_ids)[0])
+        self.Refresh()
+    
+    def get_match(self, index):
+        """Return the match shown at "index" (a MatchWithPlayers), or None if there isn't one."""
+        page_number = index // self.PAGE_SIZE
+        if page_number not in self.pages:
+            if len(self.pages) >= self.MAX_PAGES:
+                # Drop the page furthest from this one
+                del self.pages[max(self.pages, key=lambda number: abs(number - page_number))]
+            self.pages[page_number] = self.mc.get_match_page(page_number * self.PAGE_SIZE, self.PAGE_SIZE, self.exclude_disabled, self.player_ids)
+        page = self.pages[page_number]
+        if index % self.PAGE_SIZE < len(page):
+            return page[index % self.PAGE_SIZE]
+        return None
+    
+    def get_name(self, player):
+        if self.last_names:
+            return player.last_name
+        else:
+            return player.first_name + " " + player.last_name
+    
+    def OnGetItemText(self, item, column):
+        match = self.get_match(item)
+        if match is None:
+            return ""
+        if column == 0:
+            return " " + self.get_name(match.white)
+        elif column == 1:
+            return self.get_name(match.black)
+        elif column == 2:
+            if match.outcome == 0:
+                return "White victory"
+            elif match.outcome == 1:
+                return "Black victory"
+            elif match.outcome == 2:
+                return "Stalemate"
+            return "Draw"
+        elif column == 3:
+            return datetime.date.fromtimestamp(match.timestamp).strftime("%m/%d/%y")
+        else:
+            return match.enabled and "Yes" or "No"
+    
+    def OnGetItemAttr(self, item):
+        match = self.get_match(item)
+        if match is None or not self.colorize:
+            return None
+        outcome = None
+        if match.outcome in [0, 1]:
+            outcome = match.outcome
+        return self.attrs[(outcome, self.exclude_disabled or bool(match.enabled))]
+
 class MatchesPanel(wx.Panel):
     def __init__(self, parent):
         wx.Panel.__init__(self, parent=parent, id=wx.ID_ANY)
@@ -613,7 +701,7 @@ class MatchesPanel(wx.Panel):
         
         sizer = wx.BoxSizer(wx.VERTICAL)
         
-        self.list = wx.ListCtrl(self, style=wx.LC_REPORT | wx.LC_HRULES)
+        self.list = MatchesList(self, self.mc)
         self.list.InsertColumn(0, " White Player")
         self.list.InsertColumn(1, "Black Player")
         self.list.InsertColumn(2, "Outcome")
@@ -672,63 +760,30 @@ class MatchesPanel(wx.Panel):
         self.Layout()
     
     def init_list(self, no_filter=False):
-        self.itemindexes = {}
-        self.list.DeleteAllItems()
-        
         filtertext = ""
         if not no_filter:
             filtertext = self.filter_box.GetValue()
-        
-        matches = self.mc.get_matches(exclude_disabled=self.exclude_disabled)
-        for match in matches:
-            white_player = self.mc.get_players(match.white_player)[0]
-            black_player = self.mc.get_players(match.black_player)[0]
-            
-            isgood = False
-            iscomma = "," in filtertext
-            filter = filtertext.lower().split(",")
-            against = [self.get_name(player=white_player).lower(), self.get_name(player=black_player).lower()]
-            for f in filter:
-                if not iscomma or len(f.strip()) > 0:
-                    for a in against:
-                        if f.strip() in a:
-                            isgood = True
-            
-            if isgood:
-                outcome = "Draw"
-                if match.outcome == 0:
-                    outcome = "White victory"
-                elif match.outcome == 1:
-                    outcome = "Black victory"
-                elif match.outcome == 2:
-                    outcome = "Stalemate"
-                
-                index = self.list.InsertStringItem(sys.maxint, " " + self.get_name(player=white_player))
-                if not get_pref("dont_colorize_matches"):
-                    diff = 0
-                    if not self.exclude_disabled and not match.enabled:
-                        diff = 10
-                    if match.outcome == 0:
-                        self.list.SetItemBackgroundColour(index, (245 + diff, 245 + diff, 245 + diff))
-                        self.list.SetItemTextColour(index, wx.BLACK)
-                    elif match.outcome == 1:
-                        self.list.SetItemBackgroundColour(index, (0 + diff, 0 + diff, 0 + diff))
-                        self.list.SetItemTextColour(index, wx.WHITE)
-                    else:
-                        self.list.SetItemBackgroundColour(index, (190 + diff, 190 + diff, 190 + diff))
-                        self.list.SetItemTextColour(index, wx.BLACK)
-                self.itemindexes[index] = match.id
-                self.list.SetStringItem(index, 1, self.get_name(player=black_player))
-                self.list.SetStringItem(index, 2, outcome)
-                self.list.SetStringItem(index, 3, datetime.date.fromtimestamp(match.timestamp).strftime("%m/%d/%y"))
-                if not self.exclude_disabled:
-                    self.list.SetStringItem(index, 4, match.enabled and "Yes" or "No")
-        
-        for column in xrange(4):
-            self.list.SetColumnWidth(column, wx.LIST_AUTOSIZE)
-            oldwidth = self.list.GetColumnWidth(column)
+        last_names = bool(get_pref("last_names"))
+        
+        # A match is shown if either player's name starts with any of the filters (and an empty filter shows everything)
+        iscomma = "," in filtertext
+        filters = [f.strip() for f in filtertext.split(",") if not iscomma or len(f.strip()) > 0]
+        player_ids = None
+        if "" not in filters:
+            player_ids = set()
+            for f in filters:
+                player_ids.update(player.id for player in self.mc.search_players(f, include_deleted=True, last_names_only=last_names))
+            player_ids = sorted(player_ids)
+        
+        self.list.set_matches(self.exclude_disabled, player_ids, last_names, not get_pref("dont_colorize_matches"))
+        
+        # Size the columns to fit the first page of matches (a virtual list can't measure the rest without reading them)
+        for column in xrange(self.list.GetColumnCount()):
             self.list.SetColumnWidth(column, wx.LIST_AUTOSIZE_USEHEADER)
-            if oldwidth > self.list.GetColumnWidth(column): self.list.SetColumnWidth(column, wx.LIST_AUTOSIZE)
+            width = self.list.GetColumnWidth(column)
+            for index in xrange(min(self.list.GetItemCount(), self.list.PAGE_SIZE)):
+                width = max(width, self.list.GetTextExtent(self.list.OnGetItemText(index, column))[0] + 12)
+            self.list.SetColumnWidth(column, width)
     
     def OnCheck(self, event):
         self.exclude_disabled = not self.disable_checkbox.GetValue()
@@ -746,11 +801,17 @@ class MatchesPanel(wx.Panel):
         keycode = event.GetKeyCode()
         item = self.list.GetFocusedItem()
         if keycode in [wx.WXK_DELETE, wx.WXK_NUMPAD_DELETE, wx.WXK_BACK] and item != -1:
-            self.mc.remove_match(self.itemindexes[item])
-            self.list.DeleteItem(item)
+            match = self.list.get_match(item)
+            # The row may be gone if the matches changed since the list was last read
+            if match is not None:
+                self.mc.remove_match(match.id)
+            self.list.refresh()
     
     def OnListActivate(self, event):
-        match = self.mc.get_matches(self.itemindexes[event.GetIndex()])[0]
+        match = self.list.get_match(event.GetIndex())
+        if match is None:
+            self.list.refresh()
+            return
         all_players = [(p.id, self.get_name(player=p)) for p in self.mc.get_players()]
         returned_data = Struct()  # Since we can't weakref on a plain dict
         dlg = PropertiesDialog(self, "Edit Match", [
@@ -1358,8 +1419,9 @@ class RankingsTab(wx.Panel):
             sizer = wx.FlexGridSizer(wx.VERTICAL)
             sizer.SetCols(2)
             use_last_names = get_pref("last_names")
+            players = dict((p.id, p) for p in self.mc.get_players([item[0] for item in rankings]))
             for index, item in enumerate(rankings):
-                player = self.mc.get_players(item[0])[0]
+                player = players[item[0]]
                 namer = ""
                 if use_last_names:
                     namer = player.last_name
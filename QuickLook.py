@@ -17,25 +17,29 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import sys, cgi, datetime
+import sys, os, cgi, datetime, struct, tempfile, hashlib, StringIO
 
-from MasterChess import open_database
+# Bump this whenever the HTML changes, so cached previews from older versions aren't used
+RENDER_VERSION = 1
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "masterchess-quicklook")
 
-def generate_html(mc, use_big_letters=False):
+def write_html(mc, out, use_big_letters=False):
+    """Write the preview of "mc" to the file-like object "out", a piece at a time."""
+    write = out.write
     tbl = mc.get_grand_table(full_names="db")
     
     notempty = bool(len(tbl.rows) > 1 and len(tbl.rows[0]) > 0)
     
-    returning = """<!DOCTYPE html>
+    write("""<!DOCTYPE html>
 <html>
 <head>
 <style>
 h1 {
     text-align: center;
     margin: auto;
-}"""
+}""")
     if notempty:
-        returning += """
+        write("""
 table {
     border-collapse: collapse;
 }
@@ -44,9 +48,9 @@ table th, table td {
     font-size: 11pt;
     padding: 6px;
     text-align: center;
-}"""
+}""")
     if use_big_letters:
-        returning += """
+        write("""
 p {
     font-size: 62pt;
     position: absolute;
@@ -60,23 +64,23 @@ p {
 }
 p.bigger {
     font-size: 85pt;
-}"""
-    returning += "\n</style>\n</head>\n<body>\n"
+}""")
+    write("\n</style>\n</head>\n<body>\n")
     
     if notempty:
-        returning += "<table><thead><tr><th>&nbsp;</th>"
+        write("<table><thead><tr><th>&nbsp;</th>")
         for header in tbl.column_headers:
             if isinstance(header, tuple):
                 header = header[1]
-            returning += "<th>" + cgi.escape(header, True) + "</th>"
-        returning += "</tr></thead>"
+            write("<th>" + cgi.escape(header, True) + "</th>")
+        write("</tr></thead>")
         
-        returning += "<tbody>"
+        write("<tbody>")
         for index, row in enumerate(tbl.rows):
             header = tbl.row_headers[index]
             if isinstance(header, tuple):
                 header = header[1]
-            returning += "<tr><th>" + cgi.escape(header, True) + "</th>"
+            cells = ["<tr><th>" + cgi.escape(header, True) + "</th>"]
             
             for other_index, val in enumerate(row):
                 try:
@@ -87,29 +91,129 @@ p.bigger {
                 if val == None: val = "&nbsp;"
                 if index == len(tbl.row_headers) - 1 or other_index == len(tbl.column_headers) - 1:
                     val = "<i>" + str(val) + "</i>"
-                returning += "<td>" + str(val) + "</td>"
-            returning += "</tr>"
-        returning += "</tbody></table>\n"
+                cells.append("<td>" + str(val) + "</td>")
+            cells.append("</tr>")
+            write("".join(cells))
+        write("</tbody></table>\n")
         
-        matches = mc.get_matches()
-        returning += "<p>"
-        if use_big_letters: returning += "Matches: "
-        else: returning += "Total matches: "
-        returning += str(len(matches))
-        if len(matches) > 0:
-            latest_match = datetime.date.fromtimestamp(matches[-1].timestamp)
-            if use_big_letters: returning += "<br><span>Latest: "
-            else: returning += " <span style=\"float: right;\">Latest match: "
-            returning += cgi.escape(latest_match.strftime("%m/%d/%y"), True) + "</span>"
-        returning += "</p>\n"
+        # Just the count and the latest timestamp, without loading the matches
+        match_count, latest_timestamp = mc.get_match_summary()
+        write("<p>")
+        if use_big_letters: write("Matches: ")
+        else: write("Total matches: ")
+        write(str(match_count))
+        if match_count > 0:
+            latest_match = datetime.date.fromtimestamp(latest_timestamp)
+            if use_big_letters: write("<br><span>Latest: ")
+            else: write(" <span style=\"float: right;\">Latest match: ")
+            write(cgi.escape(latest_match.strftime("%m/%d/%y"), True) + "</span>")
+        write("</p>\n")
     else:
         if use_big_letters:
-            returning += "<p class=\"bigger\">Empty<br>database</p>\n"
+            write("<p class=\"bigger\">Empty<br>database</p>\n")
         else:
-            returning += "<h1>Empty MasterChess database</h1>\n"
+            write("<h1>Empty MasterChess database</h1>\n")
     
-    returning += "</body>\n</html>"
-    return returning
+    write("</body>\n</html>")
+
+def generate_html(mc, use_big_letters=False):
+    """Return the preview of "mc" as a string."""
+    out = StringIO.StringIO()
+    write_html(mc, out, use_big_letters)
+    return out.getvalue()
+
+class UTF8Tee(object):
+    """File-like object that writes everything (encoded as UTF-8) to each of "files"."""
+    
+    def __init__(self, files):
+        self.files = files
+    
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        for f in self.files:
+            f.write(data)
+
+def get_cache_key(path, use_big_letters=False):
+    """Return a string that changes whenever the database at "path" changes, without opening it with SQLite.
+    
+    PRAGMA data_version starts over in every process, so this uses the file change counter in the database header instead (which is what data_version is based on), along with the size and modification time of the database and of its write-ahead log (which gets the changes first in WAL mode).
+    """
+    parts = [RENDER_VERSION, os.path.abspath(path), bool(use_big_letters)]
+    for file_path in (path, path + "-wal"):
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+            # Opening the database creates an empty log, which doesn't change anything
+            if stat.st_size:
+                parts += [stat.st_size, stat.st_mtime]
+    f = open(path, "rb")
+    try:
+        header = f.read(28)
+    finally:
+        f.close()
+    if len(header) == 28:
+        parts.append(struct.unpack(">I", header[24:28])[0])
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+def render_cached(path, out, use_big_letters=False, cache_dir=CACHE_DIR):
+    """Write the preview of the database at "path" (as UTF-8) to "out", re-using the one rendered last time if the database hasn't changed since. Return False if the database couldn't be opened."""
+    try:
+        # The preview and the thumbnail of a database are cached side by side
+        name = hashlib.sha1(os.path.abspath(path)).hexdigest()[:16] + (use_big_letters and "-big" or "-small")
+        cache_path = os.path.join(cache_dir, name + "-" + get_cache_key(path, use_big_letters) + ".html")
+        if os.path.exists(cache_path):
+            f = open(cache_path, "rb")
+            try:
+                while True:
+                    chunk = f.read(65536)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+            finally:
+                f.close()
+            return True
+    except (IOError, OSError):
+        cache_path = None
+    
+    # Only imported when needed, so showing a cached preview stays fast
+    from MasterChess import open_database
+    mc_instance = open_database(path, readonly=True)
+    if not mc_instance:
+        return False
+    
+    cache_file = None
+    if cache_path:
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # Every render gets its own temporary file, so concurrent renders don't write over each other
+            fd, tmp_path = tempfile.mkstemp(".tmp", name + "-", cache_dir)
+            cache_file = os.fdopen(fd, "wb")
+        except (IOError, OSError):
+            cache_file = None
+    
+    try:
+        write_html(mc_instance, UTF8Tee(filter(None, [out, cache_file])), use_big_letters)
+    except:
+        if cache_file:
+            cache_file.close()
+            os.remove(tmp_path)
+        raise
+    finally:
+        mc_instance.uninit()
+        if cache_file:
+            cache_file.close()
+    
+    if cache_file:
+        try:
+            # Throw away older previews of the same database
+            for old_name in os.listdir(cache_dir):
+                if old_name.startswith(name + "-") and not old_name.endswith(".tmp"):
+                    os.remove(os.path.join(cache_dir, old_name))
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError):
+            pass
+    return True
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
@@ -120,8 +224,5 @@ if __name__ == "__main__":
                 smallsize = True
         except:
             pass
-        mc_instance = open_database(path)
-        if mc_instance:
-            print generate_html(mc_instance, smallsize)
-        else:
-            print "<html><body><h1>Error</h1><p><code>An error occurred while attempting to open the database.</code></p></body></html>"
\ No newline at end of file
+        if not render_cached(path, sys.stdout, smallsize):
+            print "<html><body><h1>Error</h1><p><code>An error occurred while attempting to open the database.</code></p></body></html>"
@@ -0,0 +1,71 @@
+"""
+Generate a synthetic league (a MasterChess database full of made-up players and matches) for benchmarking
+
+The same arguments (including "seed") always generate the same league. Some players play much more often than others: each player's share of the matches is proportional to 1 / rank ** skew (so skew=0 gives every player the same share).
+
+Usage: python benchmarks/league.py database.mcdb [players] [matches] [seed]
+"""
+
+import sys, os, random, bisect
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from MasterChess import open_database
+
+# Default chance of each "outcome" value (white win, black win, stalemate, draw)
+OUTCOMES = (0.38, 0.32, 0.05, 0.25)
+
+# Matches are spread over the year before this timestamp
+END_TIMESTAMP = 1380000000
+SPAN = 365 * 24 * 60 * 60
+
+def weighted_chooser(rng, weights):
+    """Return a function that returns an index into "weights", chosen (by "rng") in proportion to the weights."""
+    totals = []
+    total = 0.0
+    for weight in weights:
+        total += weight
+        totals.append(total)
+    def choose():
+        return min(bisect.bisect_right(totals, rng.random() * total), len(totals) - 1)
+    return choose
+
+def generate_league(path, players=100, matches=5000, outcomes=OUTCOMES, skew=1.0, seed=0, chunk_size=10000):
+    """Create a database at "path" (which must not exist yet) with "players" players and "matches" matches, and return its mc instance.
+    
+    "outcomes" is the chance of each outcome value, and "skew" says how uneven the pairings are (see the module docs).
+    """
+    if os.path.exists(path):
+        raise ValueError("%s already exists" % path)
+    rng = random.Random(seed)
+    mc_instance = open_database(path)
+    
+    mc_instance.add_players((u"First%d" % i, u"Last%d" % i, rng.randint(9, 12)) for i in xrange(players))
+    ids = [player.id for player in mc_instance.iter_players()]
+    ids.sort()
+    rng.shuffle(ids)
+    
+    choose_player = weighted_chooser(rng, [1.0 / (rank + 1) ** skew for rank in xrange(players)])
+    choose_outcome = weighted_chooser(rng, outcomes)
+    def generate():
+        for i in xrange(matches):
+            white_player = ids[choose_player()]
+            black_player = ids[choose_player()]
+            while black_player == white_player and players > 1:
+                black_player = ids[choose_player()]
+            yield (white_player, black_player, choose_outcome(), END_TIMESTAMP - SPAN + int(SPAN * float(i) / max(matches, 1)))
+    
+    rows = generate()
+    for start in xrange(0, matches, chunk_size):
+        mc_instance.add_matches([rows.next() for i in xrange(min(chunk_size, matches - start))])
+    return mc_instance
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        players = len(sys.argv) > 2 and int(sys.argv[2]) or 100
+        matches = len(sys.argv) > 3 and int(sys.argv[3]) or 5000
+        seed = len(sys.argv) > 4 and int(sys.argv[4]) or 0
+        generate_league(sys.argv[1], players, matches, seed=seed).uninit()
+        print "Generated %s (%d players, %d matches)" % (sys.argv[1], players, matches)
+    else:
+        print >> sys.stderr, "Usage: python benchmarks/league.py database.mcdb [players] [matches] [seed]"
@@ -0,0 +1,90 @@
+"""
+Compare the memory use and construction time of the record types (Player, Match, Stats) against Struct
+
+Memory is the growth of the process's peak resident memory while the records are built, each kind in a fresh Python process (so memory freed by one measurement can't be reused by the next). This counts what the records really cost, unlike adding up sys.getsizeof, which would count the dict keys every Struct shares as if each had its own copy.
+
+Usage: python benchmarks/record_memory.py [number of records]
+"""
+
+import sys, os, time, subprocess, resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from MasterChess.mc import Struct, make_stats
+from MasterChess.records import Player, Match
+
+def struct_player(i):
+    return Struct({
+        "id": i,
+        "first_name": u"First",
+        "last_name": u"Last",
+        "grade": 10,
+        "stats": {
+            "wins": 3,
+            "white_wins": 1,
+            "black_wins": 2,
+            "losses": 4,
+            "white_losses": 2,
+            "black_losses": 2,
+            "stalemates": 1,
+            "draws": 1,
+            "total": 9
+        }
+    })
+
+def record_player(i):
+    return Player(i, u"First", u"Last", 10, make_stats(1, 2, 2, 2, 1, 1, 9))
+
+def struct_match(i):
+    return Struct({
+        "id": i,
+        "enabled": 1,
+        "timestamp": 1000000 + i,
+        "white_player": 1,
+        "black_player": 2,
+        "outcome": 0
+    })
+
+def record_match(i):
+    return Match(i, 1, 1000000 + i, 1, 2, 0)
+
+MAKERS = {
+    ("player", "Struct"): struct_player,
+    ("player", "record"): record_player,
+    ("match", "Struct"): struct_match,
+    ("match", "record"): record_match
+}
+
+def peak_memory():
+    """Return the peak resident memory of this process so far, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, Mac OS X bytes
+    return sys.platform == "darwin" and peak or peak * 1024
+
+def measure(make, count):
+    """Return a tuple of (bytes, seconds) to build "count" items with "make" (see the module docs)."""
+    before = peak_memory()
+    start = time.time()
+    items = [make(i) for i in xrange(count)]
+    seconds = time.time() - start
+    return peak_memory() - before, seconds
+
+def measure_in_child(name, kind, count):
+    """Run measure for MAKERS[(name, kind)] in a new Python process and return its result."""
+    output = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", name, kind, str(count)], stdout=subprocess.PIPE).communicate()[0]
+    size, seconds = output.split()
+    return int(size), float(seconds)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 4 and sys.argv[1] == "--child":
+        size, seconds = measure(MAKERS[(sys.argv[2], sys.argv[3])], int(sys.argv[4]))
+        print size, seconds
+        sys.exit(0)
+    
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 50000
+    print "%d records each" % count
+    print "%-8s %-8s %14s %10s" % ("type", "kind", "bytes", "seconds")
+    for name in ("player", "match"):
+        for kind in ("Struct", "record"):
+            size, seconds = measure_in_child(name, kind, count)
+            print "%-8s %-8s %14d %10.3f" % (name, kind, size, seconds)
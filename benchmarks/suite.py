@@ -0,0 +1,173 @@
+"""
+Time the main MasterChess operations on synthetic leagues of several sizes (see league.py)
+
+For each size (players x matches), this times get_players, get_players with "verses", get_grand_table, get_rankings, get_stats, add_match, and QuickLook.generate_html (the best of a few runs each, with the result cache off). The results are written as JSON, and compared against a baseline (results saved earlier with --save-baseline): anything that got slower by more than the tolerance is reported as a regression, and the exit status is 1.
+
+Leagues are generated once and kept in the data directory, so later runs only spend time on the benchmarks.
+
+Usage: python benchmarks/suite.py [--sizes 20x500,100x5000,300x50000] [--output results.json] [--baseline benchmarks/baseline.json] [--save-baseline] [--tolerance 0.25]
+"""
+
+import sys, os, time, shutil, tempfile, sqlite3, optparse
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, os.pardir))
+
+from MasterChess import open_database
+import QuickLook
+from league import generate_league
+
+DEFAULT_SIZES = "20x500,100x5000,300x50000"
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baseline.json")
+
+# Differences smaller than this (in seconds) are never regressions, however big they are relative to the baseline
+MIN_DIFFERENCE = 0.001
+
+def best_time(function, repeat):
+    """Return the shortest time (in seconds) that function() took out of "repeat" calls."""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        function()
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+def get_league(data_dir, players, matches, seed):
+    """Return the path of the league with these parameters in "data_dir", generating it if it isn't there yet."""
+    path = os.path.join(data_dir, "league-%dx%d-%d.mcdb" % (players, matches, seed))
+    if not os.path.exists(path):
+        print >> sys.stderr, "Generating %s..." % path
+        generate_league(path + ".tmp", players, matches, seed=seed).uninit()
+        os.rename(path + ".tmp", path)
+    return path
+
+def run_size(path, repeat, add_count):
+    """Return a dict mapping benchmark names to seconds for the league at "path"."""
+    timings = {}
+    mc_instance = open_database(path)
+    # Most active players first, so the "verses" groups have plenty of matches between them
+    ids = [player.id for player in sorted(mc_instance.get_players(), key=lambda player: player.stats.total, reverse=True)]
+    group_size = max(len(ids) / 10, 1)
+    players = ids[:group_size]
+    verses = ids[group_size:2 * group_size] or players
+    
+    timings["get_players"] = best_time(lambda: mc_instance.get_players(), repeat)
+    timings["get_players_verses"] = best_time(lambda: mc_instance.get_players(players, verses), repeat)
+    timings["get_grand_table"] = best_time(lambda: mc_instance.get_grand_table(), repeat)
+    timings["get_rankings"] = best_time(lambda: mc_instance.get_rankings(), repeat)
+    timings["get_stats"] = best_time(lambda: mc_instance.get_stats(), repeat)
+    mc_instance.uninit()
+    
+    # Writes go to a copy, so the league stays the same for the next run
+    copy_path = path + ".copy"
+    shutil.copy(path, copy_path)
+    try:
+        mc_instance = open_database(copy_path)
+        def add_matches():
+            for i in xrange(add_count):
+                mc_instance.add_match(ids[i % len(ids)], ids[(i + 1) % len(ids)], i % 4)
+        # Time per match (each one in its own transaction)
+        timings["add_match"] = best_time(add_matches, 1) / add_count
+        mc_instance.uninit()
+    finally:
+        os.remove(copy_path)
+    
+    mc_instance = open_database(path, readonly=True)
+    timings["quicklook"] = best_time(lambda: QuickLook.generate_html(mc_instance), repeat)
+    mc_instance.uninit()
+    return timings
+
+def run(sizes, data_dir, repeat=3, add_count=200, seed=0):
+    """Run the benchmarks for every (players, matches) in "sizes" and return the results (in the format written to the JSON file)."""
+    results = {
+        "python": sys.version.split()[0],
+        "sqlite": sqlite3.sqlite_version,
+        "sizes": {}
+    }
+    for players, matches in sizes:
+        path = get_league(data_dir, players, matches, seed)
+        print >> sys.stderr, "Running %dx%d..." % (players, matches)
+        results["sizes"]["%dx%d" % (players, matches)] = {
+            "players": players,
+            "matches": matches,
+            "timings": run_size(path, repeat, add_count)
+        }
+    return results
+
+def find_regressions(results, baseline, tolerance):
+    """Return a list of (size, benchmark, baseline seconds, seconds) for every benchmark in "results" that's more than "tolerance" (a fraction) slower than in "baseline"."""
+    regressions = []
+    for size, result in sorted(results["sizes"].iteritems()):
+        if size not in baseline["sizes"]:
+            continue
+        old_timings = baseline["sizes"][size]["timings"]
+        for name, seconds in sorted(result["timings"].iteritems()):
+            if name in old_timings:
+                old_seconds = old_timings[name]
+                if seconds > old_seconds * (1 + tolerance) and seconds - old_seconds > MIN_DIFFERENCE:
+                    regressions.append((size, name, old_seconds, seconds))
+    return regressions
+
+def print_results(results, baseline=None):
+    for size, result in sorted(results["sizes"].iteritems(), key=lambda item: item[1]["matches"]):
+        print "%s (%d players, %d matches)" % (size, result["players"], result["matches"])
+        old_timings = baseline and size in baseline["sizes"] and baseline["sizes"][size]["timings"] or {}
+        for name, seconds in sorted(result["timings"].iteritems()):
+            line = "    %-20s %10.2f ms" % (name, seconds * 1000)
+            if name in old_timings:
+                line += "   (baseline %.2f ms)" % (old_timings[name] * 1000)
+            print line
+
+def parse_sizes(value):
+    """Return a list of (players, matches) tuples from a string like "20x500,100x5000"."""
+    sizes = []
+    for size in value.split(","):
+        players, matches = size.strip().lower().split("x")
+        sizes.append((int(players), int(matches)))
+    return sizes
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="python benchmarks/suite.py [options]")
+    parser.add_option("--sizes", default=DEFAULT_SIZES, help="comma-separated PLAYERSxMATCHES sizes (default: %default)")
+    parser.add_option("--output", help="write the results to this JSON file")
+    parser.add_option("--baseline", default=DEFAULT_BASELINE, help="compare against the results in this JSON file (default: %default)")
+    parser.add_option("--save-baseline", action="store_true", default=False, help="save the results as the new baseline")
+    parser.add_option("--tolerance", type="float", default=0.25, help="how much slower (as a fraction) counts as a regression (default: %default)")
+    parser.add_option("--repeat", type="int", default=3, help="runs per benchmark (default: %default)")
+    parser.add_option("--seed", type="int", default=0, help="seed for the generated leagues (default: %default)")
+    parser.add_option("--data-dir", default=os.path.join(tempfile.gettempdir(), "masterchess-benchmarks"), help="where to keep the generated leagues (default: %default)")
+    options, args = parser.parse_args()
+    
+    if not os.path.isdir(options.data_dir):
+        os.makedirs(options.data_dir)
+    results = run(parse_sizes(options.sizes), options.data_dir, options.repeat, seed=options.seed)
+    
+    baseline = None
+    if not options.save_baseline and os.path.exists(options.baseline):
+        f = open(options.baseline, "r")
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+    print_results(results, baseline)
+    
+    for path in filter(None, [options.output, options.save_baseline and options.baseline]):
+        f = open(path, "w")
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+        print "Wrote %s" % path
+    
+    if baseline:
+        regressions = find_regressions(results, baseline, options.tolerance)
+        for size, name, old_seconds, seconds in regressions:
+            print >> sys.stderr, "REGRESSION: %s %s took %.2f ms (baseline %.2f ms)" % (size, name, seconds * 1000, old_seconds * 1000)
+        if regressions:
+            sys.exit(1)